@@ -1,13 +1,30 @@
-from flask import Flask, render_template, request, session, redirect, url_for
+from flask import Flask, g, render_template, request, session, redirect, stream_template, url_for
+from flask.sessions import SecureCookieSessionInterface
+from markupsafe import Markup
+import click
 import os
-import json
+import csv
+import re
 import secrets
+import smtplib
 import hashlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
 from functools import wraps
-from collections import Counter
 from dotenv import load_dotenv
-from db import get_conn, ensure_schema
+from psycopg2.pool import PoolError
+from db import (
+    acquire_conn,
+    bulk_import_subscriptions,
+    ensure_schema,
+    execute_prepared,
+    jsonb,
+    release_conn,
+)
 from dining_checker import (
     DINING_URLS,
     find_keyword_details,
@@ -18,31 +35,123 @@ from dining_checker import (
 
 load_dotenv()
 
+# Public pages that never read or write the session.
+SESSIONLESS_PATHS = frozenset({"/stats"})
+
+
+class _SessionlessPathsInterface(SecureCookieSessionInterface):
+    """Skip verifying/re-signing the session cookie on SESSIONLESS_PATHS."""
+
+    def open_session(self, app, request):
+        if request.path in SESSIONLESS_PATHS:
+            return None  # Flask substitutes a NullSession and never saves it
+        return super().open_session(app, request)
+
+
 app = Flask(__name__)
+app.session_interface = _SessionlessPathsInterface()
 app.secret_key = os.getenv("FLASK_SECRET_KEY")
 if not app.secret_key:
     raise RuntimeError("FLASK_SECRET_KEY is not set")
+# Our forms are a handful of short fields; refuse anything bigger before
+# werkzeug spends time parsing it.
+app.config["MAX_CONTENT_LENGTH"] = 64 * 1024
+app.config["MAX_FORM_MEMORY_SIZE"] = 64 * 1024
+app.config["MAX_FORM_PARTS"] = 100
 
 SEND_WELCOME = os.getenv("SEND_WELCOME_EMAILS", "false").lower() == "true"
-ADMIN_EMAILS = {
+ADMIN_EMAILS = frozenset(
     e.strip().lower()
     for e in os.getenv("ADMIN_EMAILS", "").split(",")
     if e.strip()
-}
+)
 BASE_URL = os.getenv("BASE_URL", "").rstrip("/")
 MIT_EMAIL_DOMAIN = "mit.edu"
+_MIT_EMAIL_SUFFIX = f"@{MIT_EMAIL_DOMAIN}"
 MAGIC_TOKEN_TTL_MINUTES = int(os.getenv("MAGIC_TOKEN_TTL_MINUTES", "30"))
 LOGIN_RATE_LIMIT_ENABLED = os.getenv("LOGIN_RATE_LIMIT_ENABLED", "true").lower() == "true"
 LOGIN_RATE_LIMIT_WINDOW_MINUTES = int(os.getenv("LOGIN_RATE_LIMIT_WINDOW_MINUTES", "10"))
 LOGIN_RATE_LIMIT_MAX = int(os.getenv("LOGIN_RATE_LIMIT_MAX", "3"))
+# Oldest buckets are evicted past this many addresses.
+LOGIN_RATE_LIMIT_MAX_TRACKED = 10000
 UNSUBSCRIBE_TOKEN_TTL_DAYS = int(os.getenv("UNSUBSCRIBE_TOKEN_TTL_DAYS", "30"))
-RATE_LIMIT_BYPASS_EMAILS = {
+DEBUG_PAGE_SIZE = int(os.getenv("DEBUG_PAGE_SIZE", "500"))
+STATS_CACHE_TTL_SECONDS = int(os.getenv("STATS_CACHE_TTL_SECONDS", "60"))
+EMAIL_WORKERS = int(os.getenv("EMAIL_WORKERS", "4"))
+EMAIL_SEND_ATTEMPTS = 3
+RATE_LIMIT_BYPASS_EMAILS = frozenset({
     "simdenis@mit.edu",
-}
+})
+# Splits "a, b ,c" into ["a", "b", "c"] without a second strip() pass.
+_KEYWORD_SPLIT_RE = re.compile(r"\s*,\s*")
+# Per-request bounds on what a single subscribe POST may ask us to store.
+MAX_KEYWORDS_PER_REQUEST = 64
+MAX_KEYWORD_LENGTH = 128
+# Purge expired tokens on every Nth token created rather than on each one.
+TOKEN_PURGE_EVERY = 100
+_login_token_counter = itertools.count(1)
+_unsubscribe_token_counter = itertools.count(1)
+# email -> [tokens, last_refill (monotonic)], in least-recently-used order.
+# Per process, so the effective limit scales with WEB_CONCURRENCY.
+_login_buckets: OrderedDict[str, list[float]] = OrderedDict()
+_login_buckets_lock = threading.Lock()
+_DELETE_SUBSCRIPTION_SQL = "DELETE FROM subscriptions WHERE user_id = $1"
+
+# SMTP round trips shouldn't hold up the request that triggered them.
+_email_executor = ThreadPoolExecutor(max_workers=EMAIL_WORKERS, thread_name_prefix="email")
+
+
+def _send_email_with_retries(*args, **kwargs):
+    # Transient SMTP/network errors get a couple of retries with backoff;
+    # anything else (e.g. missing credentials) fails straight away.
+    for attempt in range(EMAIL_SEND_ATTEMPTS):
+        try:
+            return send_email(*args, **kwargs)
+        except (smtplib.SMTPException, OSError):
+            if attempt == EMAIL_SEND_ATTEMPTS - 1:
+                raise
+            time.sleep(2**attempt)
+
+
+def _send_email_in_background(description: str, to_email: str, *args, **kwargs):
+    """Queue send_email() on the email pool; failures are logged, not raised."""
+
+    def _log_failure(future):
+        exc = future.exception()
+        if exc is not None:
+            print(f"[WARN] Failed to send {description} to {to_email}: {exc}")
+
+    future = _email_executor.submit(_send_email_with_retries, to_email, *args, **kwargs)
+    future.add_done_callback(_log_failure)
+
 
 # ------------------ DB SETUP ------------------
 
 
+def get_db():
+    """
+    The pool connection for the current request, checked out on first use.
+    Use it as `with get_db() as conn:` so each block is still one
+    transaction; the connection itself goes back at teardown.
+    """
+    if "db_conn" not in g:
+        g.db_conn = acquire_conn()
+    return g.db_conn
+
+
+@app.teardown_appcontext
+def _release_db(exc):
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        release_conn(conn)
+
+
+@app.errorhandler(PoolError)
+def _db_pool_exhausted(exc):
+    print(f"[WARN] {request.method} {request.path}: {exc}")
+    return "Service busy, please try again shortly.", 503
+
+
 def login_required(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
@@ -53,7 +162,10 @@ def login_required(fn):
     return wrapper
 
 
+@app.template_global("csrf_token")
 def get_csrf_token():
+    # Exposed to templates as csrf_token() so a token is only minted (and the
+    # session cookie only written) when a rendered page actually has a form.
     token = session.get("csrf_token")
     if not token:
         token = secrets.token_urlsafe(32)
@@ -66,85 +178,116 @@ def validate_csrf():
     return token and token == session.get("csrf_token")
 
 
+# Both checks expect an already-lowercased address: login_start lowercases
+# what the user typed and users.email is stored lowercase.
 def _is_admin_email(email: str) -> bool:
-    return email.lower() in ADMIN_EMAILS
+    return email in ADMIN_EMAILS
 
 
 def _is_mit_email(email: str) -> bool:
-    return email.lower().endswith(f"@{MIT_EMAIL_DOMAIN}")
+    return email.endswith(_MIT_EMAIL_SUFFIX)
 
 
-def _hash_token(token: str) -> str:
-    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+def _is_local_path(url: str) -> bool:
+    # "//host" and "/\host" are treated as absolute URLs by browsers.
+    return url.startswith("/") and not url.startswith("//") and "\\" not in url
 
 
-def _upsert_user_by_email(email: str) -> int:
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, oidc_sub FROM users WHERE email = %s", (email,))
-            row = cur.fetchone()
-            if row:
-                return row[0]
+def _hash_token(token: str) -> str:
+    return hashlib.blake2b(token.encode("utf-8"), digest_size=32).hexdigest()
 
-            cur.execute(
-                "INSERT INTO users (email) VALUES (%s) RETURNING id",
-                (email,),
-            )
-            return cur.fetchone()[0]
+
+def _token_hash_candidates(token: str) -> list[str]:
+    # Links mailed before the switch to BLAKE2b carry SHA-256 hashed tokens;
+    # keep accepting those until UNSUBSCRIBE_TOKEN_TTL_DAYS have passed.
+    return [_hash_token(token), hashlib.sha256(token.encode("utf-8")).hexdigest()]
 
 
 def _create_login_token(email: str) -> str:
-    user_id = _upsert_user_by_email(email)
     token = secrets.token_urlsafe(32)
     token_hash = _hash_token(token)
     expires_at = datetime.utcnow() + timedelta(minutes=MAGIC_TOKEN_TTL_MINUTES)
-    with get_conn() as conn:
+    with get_db() as conn:
         with conn.cursor() as cur:
+            # Upsert the user and store the token in one round trip.
             cur.execute(
                 """
-                DELETE FROM login_tokens WHERE expires_at < NOW()
-                """
-            )
-            cur.execute(
-                """
+                WITH u AS (
+                    INSERT INTO users (email) VALUES (%s)
+                    ON CONFLICT (email) DO UPDATE SET email = EXCLUDED.email
+                    RETURNING id
+                )
                 INSERT INTO login_tokens (token_hash, user_id, expires_at, uses_left)
-                VALUES (%s, %s, %s, %s)
+                SELECT %s, u.id, %s, %s FROM u
                 """,
-                (token_hash, user_id, expires_at, 2),
+                (email, token_hash, expires_at, 2),
             )
+            # Expired tokens are harmless; sweep them occasionally, not per login.
+            if next(_login_token_counter) % TOKEN_PURGE_EVERY == 0:
+                cur.execute("DELETE FROM login_tokens WHERE expires_at < NOW()")
     return token
 
 
-def _is_rate_limited(email: str) -> bool:
-    if not LOGIN_RATE_LIMIT_ENABLED:
-        return False
-    if email.lower() in RATE_LIMIT_BYPASS_EMAILS:
-        return False
+def _count_recent_login_tokens(email: str) -> int:
     window_start = datetime.utcnow() - timedelta(minutes=LOGIN_RATE_LIMIT_WINDOW_MINUTES)
-    with get_conn() as conn:
+    with get_db() as conn:
         with conn.cursor() as cur:
+            # Walks (user_id, created_at) and stops once the limit is reached.
             cur.execute(
                 """
-                SELECT COUNT(*)
-                FROM login_tokens lt
-                JOIN users u ON u.id = lt.user_id
-                WHERE u.email = %s AND lt.created_at >= %s
+                SELECT COUNT(*) FROM (
+                    SELECT 1
+                    FROM login_tokens
+                    WHERE user_id = (SELECT id FROM users WHERE email = %s)
+                      AND created_at >= %s
+                    LIMIT %s
+                ) recent
                 """,
-                (email, window_start),
+                (email, window_start, LOGIN_RATE_LIMIT_MAX),
             )
-            count = cur.fetchone()[0]
-    return count >= LOGIN_RATE_LIMIT_MAX
+            return cur.fetchone()[0]
+
+
+def _is_rate_limited(email: str) -> bool:
+    """
+    Token bucket per email: LOGIN_RATE_LIMIT_MAX links, refilled evenly over
+    the window. Buckets live in this worker's memory; Postgres is only asked
+    (for links already sent) the first time an address shows up here.
+    """
+    if not LOGIN_RATE_LIMIT_ENABLED:
+        return False
+    if email in RATE_LIMIT_BYPASS_EMAILS:
+        return False
+
+    capacity = float(LOGIN_RATE_LIMIT_MAX)
+    refill_per_second = capacity / (LOGIN_RATE_LIMIT_WINDOW_MINUTES * 60)
+    with _login_buckets_lock:
+        bucket = _login_buckets.get(email)
+    if bucket is None:
+        # First sighting in this worker: start from the links already sent.
+        bucket = [max(0.0, capacity - _count_recent_login_tokens(email)), time.monotonic()]
+    with _login_buckets_lock:
+        bucket = _login_buckets.setdefault(email, bucket)
+        _login_buckets.move_to_end(email)
+        while len(_login_buckets) > LOGIN_RATE_LIMIT_MAX_TRACKED:
+            _login_buckets.popitem(last=False)
+
+        now = time.monotonic()
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * refill_per_second)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return True
+        bucket[0] = tokens - 1
+        return False
 
 
 def _create_unsubscribe_token(user_id: int) -> str:
     token = secrets.token_urlsafe(32)
     token_hash = _hash_token(token)
     expires_at = datetime.utcnow() + timedelta(days=UNSUBSCRIBE_TOKEN_TTL_DAYS)
-    with get_conn() as conn:
+    with get_db() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                "DELETE FROM unsubscribe_tokens WHERE expires_at < NOW()"
-            )
             cur.execute(
                 """
                 INSERT INTO unsubscribe_tokens (token_hash, user_id, expires_at)
@@ -152,70 +295,59 @@ def _create_unsubscribe_token(user_id: int) -> str:
                 """,
                 (token_hash, user_id, expires_at),
             )
+            if next(_unsubscribe_token_counter) % TOKEN_PURGE_EVERY == 0:
+                cur.execute("DELETE FROM unsubscribe_tokens WHERE expires_at < NOW()")
     return token
 
 
 def _consume_unsubscribe_token(token: str):
-    token_hash = _hash_token(token)
-    with get_conn() as conn:
+    with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
-                SELECT user_id FROM unsubscribe_tokens
-                WHERE token_hash = %s AND expires_at > NOW()
+                DELETE FROM unsubscribe_tokens
+                WHERE token_hash = ANY(%s) AND expires_at > NOW()
+                RETURNING user_id
                 """,
-                (token_hash,),
+                (_token_hash_candidates(token),),
             )
             row = cur.fetchone()
-            if row:
-                cur.execute(
-                    "DELETE FROM unsubscribe_tokens WHERE token_hash = %s",
-                    (token_hash,),
-                )
-                return row[0]
-    return None
+    return row[0] if row else None
 
 
 def _consume_login_token(token: str):
-    token_hash = _hash_token(token)
-    with get_conn() as conn:
+    """Use up one sign-in from a magic link; returns (user_id, email) or None."""
+    with get_db() as conn:
         with conn.cursor() as cur:
+            # Atomic decrement: two concurrent clicks can't both spend the last use.
+            # Spent rows (uses_left = 0) are left for the expired-token sweep.
             cur.execute(
                 """
-                SELECT user_id, uses_left FROM login_tokens
-                WHERE token_hash = %s AND expires_at > NOW()
+                WITH consumed AS (
+                    UPDATE login_tokens SET uses_left = uses_left - 1
+                    WHERE token_hash = ANY(%s) AND expires_at > NOW() AND uses_left > 0
+                    RETURNING user_id
+                )
+                SELECT c.user_id, u.email
+                FROM consumed c
+                JOIN users u ON u.id = c.user_id
                 """,
-                (token_hash,),
+                (_token_hash_candidates(token),),
             )
             row = cur.fetchone()
-            if row:
-                user_id, uses_left = row
-                uses_left -= 1
-                if uses_left <= 0:
-                    cur.execute(
-                        "DELETE FROM login_tokens WHERE token_hash = %s",
-                        (token_hash,),
-                    )
-                else:
-                    cur.execute(
-                        """
-                        UPDATE login_tokens SET uses_left = %s
-                        WHERE token_hash = %s
-                        """,
-                        (uses_left, token_hash),
-                    )
-                return user_id
-    return None
+    return row
 
 
 def _get_subscription(user_id: int):
-    with get_conn() as conn:
+    with get_db() as conn:
         with conn.cursor() as cur:
-            cur.execute(
+            execute_prepared(
+                cur,
+                "get_subscription",
                 """
                 SELECT item_keywords, halls, last_notified_date
                 FROM subscriptions
-                WHERE user_id = %s
+                WHERE user_id = $1
                 """,
                 (user_id,),
             )
@@ -223,69 +355,126 @@ def _get_subscription(user_id: int):
     if not row:
         return None
 
-    kw_json, halls_json, last_notified = row
-    try:
-        keywords = json.loads(kw_json) if kw_json else []
-    except Exception:
-        keywords = []
-    try:
-        halls = json.loads(halls_json) if halls_json else []
-    except Exception:
-        halls = []
+    keywords, halls, last_notified = row
     return {
-        "keywords": keywords,
-        "halls": halls,
+        "keywords": keywords or [],
+        "halls": halls or [],
         "last_notified": last_notified,
     }
 
 
-# Run once at import time so gunicorn + local both get the table.
-ensure_schema()
-
-DINING_HALLS = sorted(DINING_URLS.keys())
+# (keyword_limit, hall_limit) -> (computed_at, stats); per process.
+_stats_cache: dict[tuple[int, int], tuple[float, tuple]] = {}
 
 
-# ------------------ ROUTES ------------------
+def _invalidate_subscription_stats():
+    _stats_cache.clear()
 
 
-@app.route("/", methods=["GET"])
-def index():
-    login_next = request.args.get("next", "")
-    message = session.pop("flash_message", "")
-    keyword_counts = Counter()
-    hall_counts = Counter()
-    total_subscriptions = 0
+def _get_subscription_stats(keyword_limit: int, hall_limit: int):
+    """
+    Return (total, top keyword counts, top hall counts), counted in Postgres.
+    Cached for STATS_CACHE_TTL_SECONDS; writes in this process clear it early.
+    """
+    key = (keyword_limit, hall_limit)
+    cached = _stats_cache.get(key)
+    if cached and time.monotonic() - cached[0] < STATS_CACHE_TTL_SECONDS:
+        return cached[1]
 
-    with get_conn() as conn:
+    with get_db() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT item_keywords, halls FROM subscriptions")
-            rows = cur.fetchall()
+            cur.execute("SELECT COUNT(*) FROM subscriptions")
+            total = cur.fetchone()[0]
+            cur.execute(
+                """
+                SELECT kw, COUNT(*)
+                FROM subscriptions, jsonb_array_elements_text(item_keywords) AS kw
+                WHERE kw <> ''
+                GROUP BY kw
+                ORDER BY COUNT(*) DESC, kw
+                LIMIT %s
+                """,
+                (keyword_limit,),
+            )
+            top_keywords = cur.fetchall()
+            cur.execute(
+                """
+                SELECT hall, COUNT(*)
+                FROM subscriptions, jsonb_array_elements_text(halls) AS hall
+                WHERE hall <> ''
+                GROUP BY hall
+                ORDER BY COUNT(*) DESC, hall
+                LIMIT %s
+                """,
+                (hall_limit,),
+            )
+            top_halls = cur.fetchall()
+    result = (total, top_keywords, top_halls)
+    _stats_cache[key] = (time.monotonic(), result)
+    return result
 
-    for kw_json, halls_json in rows:
-        total_subscriptions += 1
-        try:
-            keywords = json.loads(kw_json) if kw_json else []
-        except Exception:
-            keywords = []
-        try:
-            halls = json.loads(halls_json) if halls_json else []
-        except Exception:
-            halls = []
 
-        keyword_counts.update([k for k in keywords if k])
-        hall_counts.update([h for h in halls if h])
+DINING_HALLS = tuple(sorted(DINING_URLS.keys()))
+DINING_HALLS_SET = frozenset(DINING_HALLS)
+# The hall picker never changes, so render its <option> list once.
+HALL_OPTIONS_HTML = Markup("").join(
+    Markup('<option value="{0}">{0}</option>').format(hall) for hall in DINING_HALLS
+)
+
 
+def _render_index(message: str = "", **context):
+    context.setdefault("is_logged_in", "user_id" in session)
+    context.setdefault("user_email", session.get("user_email", ""))
     return render_template(
         "index.html",
         message=message,
-        halls=DINING_HALLS,
-        csrf_token=get_csrf_token(),
-        is_logged_in="user_id" in session,
-        user_email=session.get("user_email", ""),
+        hall_options=HALL_OPTIONS_HTML,
+        **context,
+    )
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create or migrate the database schema."""
+    ensure_schema()
+    print("Database schema is up to date.")
+
+
+@app.cli.command("import-subscriptions")
+@click.argument("csv_file", type=click.File("r", encoding="utf-8"))
+def import_subscriptions_command(csv_file):
+    """Bulk-load subscriptions from a CSV of email,keywords,halls rows.
+
+    Keywords and halls are comma-separated within their (quoted) columns.
+    """
+    rows = (
+        (
+            row[0],
+            [k for k in _KEYWORD_SPLIT_RE.split(row[1].strip()) if k],
+            [h for h in _KEYWORD_SPLIT_RE.split(row[2].strip()) if h] if len(row) > 2 else [],
+        )
+        for row in csv.reader(csv_file)
+        if len(row) >= 2
+    )
+    count = bulk_import_subscriptions(rows)
+    print(f"Imported {count} subscriptions.")
+
+
+# ------------------ ROUTES ------------------
+
+
+@app.route("/", methods=["GET"])
+def index():
+    login_next = request.args.get("next", "")
+    message = session.pop("flash_message", "")
+    total_subscriptions, top_keywords, top_halls = _get_subscription_stats(5, 5)
+
+    return _render_index(
+        message,
         profile_url=url_for("profile"),
         total_subscriptions=total_subscriptions,
-        top_keywords=keyword_counts.most_common(5),
-        top_halls=hall_counts.most_common(5),
+        top_keywords=top_keywords,
+        top_halls=top_halls,
         login_next=login_next,
     )
 
@@ -296,26 +485,20 @@ def login_start():
 
     email = request.form.get("email", "").strip().lower()
     next_url = request.form.get("next", "")
-    if next_url.startswith("/"):
+    if _is_local_path(next_url):
         session["post_login_redirect"] = next_url
 
     if not email or not _is_mit_email(email):
-        return render_template(
-            "index.html",
-            message="Please use your @mit.edu email to sign in.",
-            halls=DINING_HALLS,
-            csrf_token=get_csrf_token(),
+        return _render_index(
+            "Please use your @mit.edu email to sign in.",
             is_logged_in=False,
             user_email="",
             login_next=next_url,
         )
 
     if _is_rate_limited(email):
-        return render_template(
-            "index.html",
-            message="Too many login links requested. Try again in a few minutes.",
-            halls=DINING_HALLS,
-            csrf_token=get_csrf_token(),
+        return _render_index(
+            "Too many login links requested. Try again in a few minutes.",
             is_logged_in=False,
             user_email="",
             login_next=next_url,
@@ -344,30 +527,16 @@ def login_start():
       <p style="margin: 0; color: #6b7280;">This link expires in {MAGIC_TOKEN_TTL_MINUTES} minutes.</p>
     </div>
     """
-    try:
-        send_email(
-            email,
-            "MIT Dining Alerts — sign in",
-            "\n".join(body_lines),
-            html_body=html_body,
-        )
-    except Exception as e:
-        print(f"[WARN] Failed to send login link to {email}: {e}")
-        return render_template(
-            "index.html",
-            message="We couldn’t send the login email. Please try again later.",
-            halls=DINING_HALLS,
-            csrf_token=get_csrf_token(),
-            is_logged_in=False,
-            user_email="",
-            login_next=next_url,
-        )
+    _send_email_in_background(
+        "login link",
+        email,
+        "MIT Dining Alerts — sign in",
+        "\n".join(body_lines),
+        html_body=html_body,
+    )
 
-    return render_template(
-        "index.html",
-        message="Check your email for a sign-in link.",
-        halls=DINING_HALLS,
-        csrf_token=get_csrf_token(),
+    return _render_index(
+        "Check your email for a sign-in link.",
         is_logged_in=False,
         user_email="",
         login_next=next_url,
@@ -381,21 +550,15 @@ def magic_login():
         if not token:
             return "Invalid login link", 400
 
-        user_id = _consume_login_token(token)
-        if not user_id:
+        consumed = _consume_login_token(token)
+        if not consumed:
             return "Login link expired or invalid", 400
-
-        with get_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT email FROM users WHERE id = %s", (user_id,))
-                row = cur.fetchone()
-                if not row:
-                    return "Invalid login", 400
-                email = row[0]
+        user_id, email = consumed
 
         session["user_id"] = user_id
         session["user_email"] = email
-        return redirect(session.pop("post_login_redirect", url_for("index")))
+        next_url = session.pop("post_login_redirect", "")
+        return redirect(next_url if _is_local_path(next_url) else url_for("index"))
 
     token = request.args.get("token", "")
     if not token:
@@ -429,20 +592,22 @@ def profile():
         except Exception as e:
             print(f"[WARN] Failed to load today menu for profile: {e}")
 
-    keyword_counts = Counter()
     if subscription:
-        with get_conn() as conn:
+        # Most popular magic words this user doesn't already have.
+        with get_db() as conn:
             with conn.cursor() as cur:
-                cur.execute("SELECT item_keywords FROM subscriptions")
-                rows = cur.fetchall()
-        for (kw_json,) in rows:
-            try:
-                keywords = json.loads(kw_json) if kw_json else []
-            except Exception:
-                keywords = []
-            keyword_counts.update([k for k in keywords if k])
-        existing = set(subscription["keywords"])
-        suggestions = [k for k, _ in keyword_counts.most_common() if k not in existing][:5]
+                cur.execute(
+                    """
+                    SELECT kw
+                    FROM subscriptions, jsonb_array_elements_text(item_keywords) AS kw
+                    WHERE kw <> '' AND NOT kw = ANY(%s)
+                    GROUP BY kw
+                    ORDER BY COUNT(*) DESC, kw
+                    LIMIT 5
+                    """,
+                    (subscription["keywords"],),
+                )
+                suggestions = [row[0] for row in cur.fetchall()]
     return render_template(
         "profile.html",
         subscription=subscription,
@@ -451,7 +616,6 @@ def profile():
         suggestions=suggestions,
         user_email=session.get("user_email", ""),
         profile_url=url_for("profile"),
-        csrf_token=get_csrf_token(),
     )
 
 
@@ -465,24 +629,18 @@ def remove_keyword():
     if not keyword:
         return redirect(url_for("profile"))
 
-    subscription = _get_subscription(session["user_id"])
-    if not subscription:
-        return redirect(url_for("profile"))
-
-    keywords = [k for k in subscription["keywords"] if k != keyword]
-    halls = subscription["halls"] or []
-    halls_json = json.dumps(halls) if halls else None
-
-    with get_conn() as conn:
+    # jsonb "-" drops every matching string element in place.
+    with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
                 UPDATE subscriptions
-                SET item_keywords = %s, halls = %s
+                SET item_keywords = item_keywords - %s
                 WHERE user_id = %s
                 """,
-                (json.dumps(keywords), halls_json, session["user_id"]),
+                (keyword, session["user_id"]),
             )
+    _invalidate_subscription_stats()
 
     return redirect(url_for("profile"))
 
@@ -497,58 +655,30 @@ def remove_hall():
     if not hall:
         return redirect(url_for("profile"))
 
-    subscription = _get_subscription(session["user_id"])
-    if not subscription:
-        return redirect(url_for("profile"))
-
-    halls = [h for h in subscription["halls"] if h != hall]
-    keywords = subscription["keywords"] or []
-    halls_json = json.dumps(halls) if halls else None
-
-    with get_conn() as conn:
+    with get_db() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
                 UPDATE subscriptions
-                SET item_keywords = %s, halls = %s
+                SET halls = NULLIF(halls - %s, '[]'::jsonb)
                 WHERE user_id = %s
                 """,
-                (json.dumps(keywords), halls_json, session["user_id"]),
+                (hall, session["user_id"]),
             )
+    _invalidate_subscription_stats()
 
     return redirect(url_for("profile"))
 
 
 @app.route("/stats", methods=["GET"])
 def stats():
-    keyword_counts = Counter()
-    hall_counts = Counter()
-    total_subscriptions = 0
-
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT item_keywords, halls FROM subscriptions")
-            rows = cur.fetchall()
-
-    for kw_json, halls_json in rows:
-        total_subscriptions += 1
-        try:
-            keywords = json.loads(kw_json) if kw_json else []
-        except Exception:
-            keywords = []
-        try:
-            halls = json.loads(halls_json) if halls_json else []
-        except Exception:
-            halls = []
-
-        keyword_counts.update([k for k in keywords if k])
-        hall_counts.update([h for h in halls if h])
+    total_subscriptions, keyword_counts, hall_counts = _get_subscription_stats(20, 10)
 
     return render_template(
         "stats.html",
         total_subscriptions=total_subscriptions,
-        keyword_counts=keyword_counts.most_common(20),
-        hall_counts=hall_counts.most_common(10),
+        keyword_counts=keyword_counts,
+        hall_counts=hall_counts,
     )
 
 
@@ -589,103 +719,88 @@ def subscribe():
     email = session.get("user_email", "").strip()
     keywords_str = request.form.get("keywords", "").strip()
     halls_selected = request.form.getlist("halls")
-    halls_list = halls_selected or None
+    # dict.fromkeys de-duplicates while keeping the order they were entered in;
+    # anything that isn't a known hall is dropped rather than stored.
+    halls_list = [h for h in dict.fromkeys(halls_selected) if h in DINING_HALLS_SET] or None
 
     # Parse magic words: comma-separated, allow spaces inside phrases
-    new_keywords = [k.strip() for k in keywords_str.split(",") if k.strip()]
+    new_keywords = list(dict.fromkeys(k for k in _KEYWORD_SPLIT_RE.split(keywords_str) if k))
 
     if not email or not new_keywords:
-        return render_template(
-            "index.html",
-            message="Please provide at least one magic word (comma-separated).",
-            halls=DINING_HALLS,
-            csrf_token=get_csrf_token(),
+        return _render_index(
+            "Please provide at least one magic word (comma-separated).",
             is_logged_in=True,
             user_email=email,
         )
 
-    # Look up existing subscription
-    with get_conn() as conn:
+    if len(new_keywords) > MAX_KEYWORDS_PER_REQUEST or any(
+        len(k) > MAX_KEYWORD_LENGTH for k in new_keywords
+    ):
+        return (
+            _render_index(
+                f"Please keep it to {MAX_KEYWORDS_PER_REQUEST} magic words of at most "
+                f"{MAX_KEYWORD_LENGTH} characters each.",
+                is_logged_in=True,
+                user_email=email,
+            ),
+            400,
+        )
+
+    # Merge into any existing subscription server-side, preserving order.
+    with get_db() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                "SELECT item_keywords, halls FROM subscriptions WHERE user_id = %s",
-                (session["user_id"],),
+            execute_prepared(
+                cur,
+                "upsert_subscription",
+                """
+                INSERT INTO subscriptions
+                (user_id, item_keywords, halls, last_notified_date)
+                VALUES ($1, $2, $3, NULL)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    item_keywords = jsonb_array_union(
+                        subscriptions.item_keywords, EXCLUDED.item_keywords
+                    ),
+                    halls = NULLIF(
+                        jsonb_array_union(subscriptions.halls, EXCLUDED.halls),
+                        '[]'::jsonb
+                    )
+                RETURNING (xmax = 0) AS inserted
+                """,
+                (
+                    session["user_id"],
+                    jsonb(new_keywords),
+                    jsonb(halls_list) if halls_list else None,
+                ),
             )
-            row = cur.fetchone()
-
-            if row:
-                current_kw_json, current_halls_json = row
-                current_keywords = (
-                    json.loads(current_kw_json) if current_kw_json else []
-                )
-
-                # Merge keywords
-                for kw in new_keywords:
-                    if kw not in current_keywords:
-                        current_keywords.append(kw)
-
-                # Merge halls
-                if current_halls_json:
-                    stored_halls = json.loads(current_halls_json)
-                else:
-                    stored_halls = []
-
-                if halls_list:
-                    for h in halls_list:
-                        if h not in stored_halls:
-                            stored_halls.append(h)
-
-                halls_json = json.dumps(stored_halls) if stored_halls else None
-
-                cur.execute(
-                    """
-                    UPDATE subscriptions
-                    SET item_keywords = %s, halls = %s
-                    WHERE user_id = %s
-                    """,
-                    (json.dumps(current_keywords), halls_json, session["user_id"]),
-                )
-            else:
-                # New subscriber
-                keywords_json = json.dumps(new_keywords)
-                halls_json = json.dumps(halls_list) if halls_list else None
-                cur.execute(
-                    """
-                    INSERT INTO subscriptions
-                    (user_id, item_keywords, halls, last_notified_date)
-                    VALUES (%s, %s, %s, NULL)
-                    """,
-                    (session["user_id"], keywords_json, halls_json),
-                )
-
-                if SEND_WELCOME:
-                    try:
-                        body_lines = [
-                            "Welcome to MIT Dining Alerts 🌶️",
-                            "",
-                            "We'll email you when your magic words show up on the dining menus:",
-                            f"  • {', '.join(new_keywords)}",
-                            "",
-                            "Manage your alerts any time from the site.",
-                        ]
-                        html_body = f"""
-                        <div style="font-family: -apple-system, BlinkMacSystemFont, 'SF Pro Text', Arial, sans-serif; line-height: 1.5;">
-                          <h2 style="margin: 0 0 8px;">Welcome to MIT Dining Alerts 🌶️</h2>
-                          <p style="margin: 0 0 12px;">We’ll email you when your magic words appear:</p>
-                          <ul style="margin: 0 0 16px; padding-left: 18px;">
-                            <li>{', '.join(new_keywords)}</li>
-                          </ul>
-                          <p style="margin: 0;">Manage your alerts any time from the site.</p>
-                        </div>
-                        """
-                        send_email(
-                            email,
-                            "Welcome to MIT Dining Alerts 🌶️",
-                            "\n".join(body_lines),
-                            html_body=html_body,
-                        )
-                    except Exception as e:
-                        print(f"[WARN] Failed to send welcome email to {email}: {e}")
+            is_new = cur.fetchone()[0]
+    _invalidate_subscription_stats()
+
+    if is_new and SEND_WELCOME:
+        body_lines = [
+            "Welcome to MIT Dining Alerts 🌶️",
+            "",
+            "We'll email you when your magic words show up on the dining menus:",
+            f"  • {', '.join(new_keywords)}",
+            "",
+            "Manage your alerts any time from the site.",
+        ]
+        html_body = f"""
+        <div style="font-family: -apple-system, BlinkMacSystemFont, 'SF Pro Text', Arial, sans-serif; line-height: 1.5;">
+          <h2 style="margin: 0 0 8px;">Welcome to MIT Dining Alerts 🌶️</h2>
+          <p style="margin: 0 0 12px;">We’ll email you when your magic words appear:</p>
+          <ul style="margin: 0 0 16px; padding-left: 18px;">
+            <li>{', '.join(new_keywords)}</li>
+          </ul>
+          <p style="margin: 0;">Manage your alerts any time from the site.</p>
+        </div>
+        """
+        _send_email_in_background(
+            "welcome email",
+            email,
+            "Welcome to MIT Dining Alerts 🌶️",
+            "\n".join(body_lines),
+            html_body=html_body,
+        )
 
     session["flash_message"] = (
         "Subscribed! We’ll watch for dishes matching: "
@@ -703,21 +818,21 @@ def unsubscribe():
 
     email = session.get("user_email", "").strip()
 
-    with get_conn() as conn:
+    with get_db() as conn:
         with conn.cursor() as cur:
-            cur.execute("DELETE FROM subscriptions WHERE user_id = %s", (session["user_id"],))
+            execute_prepared(
+                cur, "delete_subscription", _DELETE_SUBSCRIPTION_SQL, (session["user_id"],)
+            )
             affected = cur.rowcount
+    _invalidate_subscription_stats()
 
     if affected == 0:
         msg = "No active subscriptions found for that email."
     else:
         msg = "You’ve been unsubscribed from all alerts for this email."
 
-    return render_template(
-        "index.html",
-        message=msg,
-        halls=DINING_HALLS,
-        csrf_token=get_csrf_token(),
+    return _render_index(
+        msg,
         is_logged_in=True,
         user_email=email,
     )
@@ -734,18 +849,12 @@ def unsubscribe_confirm():
         if not user_id:
             return "Unsubscribe link expired or invalid", 400
 
-        with get_conn() as conn:
+        with get_db() as conn:
             with conn.cursor() as cur:
-                cur.execute("DELETE FROM subscriptions WHERE user_id = %s", (user_id,))
-
-        return render_template(
-            "index.html",
-            message="You’ve been unsubscribed from all alerts for this email.",
-            halls=DINING_HALLS,
-            csrf_token=get_csrf_token(),
-            is_logged_in="user_id" in session,
-            user_email=session.get("user_email", ""),
-        )
+                execute_prepared(cur, "delete_subscription", _DELETE_SUBSCRIPTION_SQL, (user_id,))
+        _invalidate_subscription_stats()
+
+        return _render_index("You’ve been unsubscribed from all alerts for this email.")
 
     token = request.args.get("token", "")
     if not token:
@@ -756,48 +865,44 @@ def unsubscribe_confirm():
 # --------------- DEBUG VIEW (admin only) ---------------
 
 
-@app.route("/debug/subscriptions")
-@login_required
-def debug_subscriptions():
-    """
-    Simple HTML table showing all subscriptions.
-    Protected by ADMIN_EMAILS allowlist.
-    """
-    if not _is_admin_email(session.get("user_email", "")):
-        return "Forbidden", 403
-
-    with get_conn() as conn:
-        with conn.cursor() as cur:
+def _iter_debug_subscriptions(after: str, limit: int):
+    # Keyset pagination on users.email (unique index) and a named cursor, so
+    # neither Postgres nor Python materializes the whole table.
+    with get_db() as conn:
+        with conn.cursor(name="debug_subscriptions", withhold=True) as cur:
+            cur.itersize = 500
             cur.execute(
                 """
-                SELECT u.email, s.item_keywords, s.halls, s.last_notified_date
+                SELECT u.email, s.item_keywords::text, s.halls::text, s.last_notified_date
                 FROM subscriptions s
                 JOIN users u ON u.id = s.user_id
+                WHERE u.email > %s
                 ORDER BY u.email
-                """
+                LIMIT %s
+                """,
+                (after, limit),
             )
-            rows = cur.fetchall()
+            yield from cur
 
-    html = [
-        "<h1>Subscriptions</h1>",
-        "<table border='1' cellpadding='4'>",
-        "<tr><th>Email</th><th>Keywords (JSON)</th>"
-        "<th>Halls (JSON)</th><th>Last notified</th></tr>",
-    ]
 
-    for email, kw_json, halls_json, last_notified in rows:
-        html.append(
-            "<tr>"
-            f"<td>{email}</td>"
-            f"<td><code>{kw_json}</code></td>"
-            f"<td><code>{halls_json}</code></td>"
-            f"<td>{last_notified}</td>"
-            "</tr>"
-        )
+@app.route("/debug/subscriptions")
+@login_required
+def debug_subscriptions():
+    """
+    Simple HTML table showing subscriptions, one page at a time.
+    Protected by ADMIN_EMAILS allowlist.
+    """
+    if not _is_admin_email(session.get("user_email", "")):
+        return "Forbidden", 403
 
-    html.append("</table>")
-    return "\n".join(html)
+    after = request.args.get("after", "")
+    return stream_template(
+        "debug_subscriptions.html",
+        rows=_iter_debug_subscriptions(after, DEBUG_PAGE_SIZE),
+        page_size=DEBUG_PAGE_SIZE,
+    )
 
 
 if __name__ == "__main__":
+    ensure_schema()
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5002)), debug=True)
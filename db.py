@@ -1,7 +1,22 @@
 # db.py
+import csv
+import io
 import os
+import re
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+import orjson
 from dotenv import load_dotenv
-import psycopg2
+from psycopg2 import errors
+from psycopg2.extensions import (
+    TRANSACTION_STATUS_IDLE,
+    TRANSACTION_STATUS_INERROR,
+    TRANSACTION_STATUS_INTRANS,
+)
+from psycopg2.extras import Json, register_default_jsonb
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 
 load_dotenv()
 
@@ -10,23 +25,233 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL is not set")
 
+# PG_POOL_MIN connections are opened up front; up to PG_POOL_MAX are kept
+# open once they have been needed.
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+# Neon (and most proxies) drop idle connections; recycle ours before that.
+PG_POOL_MAX_IDLE_SECONDS = int(os.getenv("PG_POOL_MAX_IDLE_SECONDS", "240"))
+# How long acquire_conn() waits for a free connection before giving up.
+PG_POOL_TIMEOUT_SECONDS = float(os.getenv("PG_POOL_TIMEOUT_SECONDS", "10"))
 
-def get_conn():
+# Decode JSONB columns with orjson instead of the stdlib json module.
+register_default_jsonb(globally=True, loads=orjson.loads)
+
+
+def _dumps_json(value) -> str:
+    return orjson.dumps(value).decode("utf-8")
+
+
+def jsonb(value) -> Json:
+    """Wrap a Python value for a JSONB parameter, encoded with orjson."""
+    return Json(value, dumps=_dumps_json)
+
+
+# Arbitrary app-wide key for pg_advisory_xact_lock around schema changes.
+SCHEMA_LOCK_KEY = 0x6A616C61
+
+_pool: ThreadedConnectionPool | None = None
+_pool_lock = threading.Lock()
+# psycopg2's pool raises when exhausted; make callers wait for a slot instead,
+# up to PG_POOL_TIMEOUT_SECONDS so a leak or deadlock fails loudly.
+_pool_slots = threading.BoundedSemaphore(PG_POOL_MAX)
+# When each idle pooled connection was handed back (monotonic).
+_last_used: "weakref.WeakKeyDictionary[object, float]" = weakref.WeakKeyDictionary()
+# The first connection each thread checked out, for get_conn() to reuse.
+_held = threading.local()
+# Names of the statements already PREPAREd on each pooled connection.
+_prepared: "weakref.WeakKeyDictionary[object, set[str]]" = weakref.WeakKeyDictionary()
+# Connections whose prepared statements already had to be rebuilt once.
+_prepared_resets: "weakref.WeakSet[object]" = weakref.WeakSet()
+# Turned off for the process once the server turns out not to keep them.
+_use_prepared = True
+_PREPARED_SAVEPOINT = "execute_prepared"
+_DOLLAR_PARAM_RE = re.compile(r"\$(\d+)")
+
+
+def _get_pool() -> ThreadedConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ThreadedConnectionPool(PG_POOL_MIN, PG_POOL_MAX, DATABASE_URL)
+                # psycopg2 closes any connection handed back while minconn are
+                # already idle, so past PG_POOL_MIN concurrent users every
+                # release would cost a reconnect. Keep them all instead.
+                pool.minconn = PG_POOL_MAX
+                _pool = pool
+    return _pool
+
+
+def _checkout(pool: ThreadedConnectionPool):
+    conn = pool.getconn()
+    last_used = _last_used.pop(conn, None)
+    stale = last_used is not None and time.monotonic() - last_used > PG_POOL_MAX_IDLE_SECONDS
+    if conn.closed or stale:
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    conn.autocommit = True
+    return conn
+
+
+def acquire_conn():
     """
-    Return a psycopg2 connection to Postgres.
-    autocommit=True so we don't have to call conn.commit() manually.
+    Check a psycopg2 connection out of the process-wide pool, waiting up to
+    PG_POOL_TIMEOUT_SECONDS for a free slot before raising PoolError. Every
+    call must be paired with release_conn().
     """
-    conn = psycopg2.connect(DATABASE_URL)
-    conn.autocommit = True
+    if not _pool_slots.acquire(timeout=PG_POOL_TIMEOUT_SECONDS):
+        raise PoolError(
+            f"no free database connection after {PG_POOL_TIMEOUT_SECONDS:g}s "
+            f"(PG_POOL_MAX={PG_POOL_MAX})"
+        )
+    try:
+        conn = _checkout(_get_pool())
+    except BaseException:
+        _pool_slots.release()
+        raise
+    if getattr(_held, "conn", None) is None:
+        _held.conn = conn
     return conn
 
 
+def release_conn(conn):
+    """Return a connection obtained from acquire_conn() to the pool."""
+    if getattr(_held, "conn", None) is conn:
+        _held.conn = None
+    try:
+        if not conn.closed:
+            _last_used[conn] = time.monotonic()
+        _get_pool().putconn(conn, close=bool(conn.closed))
+        if conn.closed:
+            # Discarded by the pool (e.g. the server dropped it).
+            _last_used.pop(conn, None)
+    finally:
+        _pool_slots.release()
+
+
+@contextmanager
+def get_conn():
+    """
+    Check a psycopg2 connection out of the process-wide pool.
+    autocommit=True so we don't have to call conn.commit() manually; the
+    block still runs as one transaction and the connection goes back to the
+    pool (instead of being closed) on exit.
+    If this thread already holds a connection (a request's get_db(), the
+    notifier's run) with no transaction open, the block runs on that one
+    rather than taking a second pool slot.
+    """
+    held = getattr(_held, "conn", None)
+    if (
+        held is not None
+        and not held.closed
+        and held.info.transaction_status == TRANSACTION_STATUS_IDLE
+    ):
+        with held:
+            yield held
+        return
+    conn = acquire_conn()
+    try:
+        with conn:
+            yield conn
+    finally:
+        release_conn(conn)
+
+
+def _execute_unprepared(cur, sql: str, params: tuple) -> None:
+    """Run execute_prepared()'s $n-placeholder sql as an ordinary query."""
+    order: list[int] = []
+
+    def placeholder(match):
+        order.append(int(match.group(1)) - 1)
+        return "%s"
+
+    query = _DOLLAR_PARAM_RE.sub(placeholder, sql.replace("%", "%%"))
+    cur.execute(query, [params[i] for i in order])
+
+
+def _prepared_round_trip(cur, name: str, sql: str, params: tuple, prepare: bool, reset: bool) -> None:
+    """[SAVEPOINT] [DEALLOCATE ALL] [PREPARE] EXECUTE, sent as one query."""
+    statements = []
+    if cur.connection.info.transaction_status == TRANSACTION_STATUS_INTRANS:
+        # Lets a failed EXECUTE be undone without aborting the caller's
+        # transaction; it is released when that transaction ends.
+        statements.append(f"SAVEPOINT {_PREPARED_SAVEPOINT}")
+    if reset:
+        statements.append("DEALLOCATE ALL")
+    if prepare:
+        statements.append(f"PREPARE {name} AS {sql.replace('%', '%%') if params else sql}")
+    if params:
+        statements.append(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})")
+    else:
+        statements.append(f"EXECUTE {name}")
+    cur.execute("; ".join(statements), params or None)
+
+
+def _undo_failed_round_trip(cur, had_savepoint: bool) -> None:
+    if had_savepoint:
+        cur.execute(f"ROLLBACK TO SAVEPOINT {_PREPARED_SAVEPOINT}")
+    elif cur.connection.info.transaction_status == TRANSACTION_STATUS_INERROR:
+        # The failed query opened the transaction (psycopg2 sends BEGIN first
+        # inside `with conn:`), so nothing else is lost; reopen it empty.
+        cur.execute("ROLLBACK; BEGIN")
+
+
+def execute_prepared(cur, name: str, sql: str, params: tuple = ()):
+    """
+    Run sql as a named server-side prepared statement.
+    psycopg2 has no prepare=True, so the statement is PREPAREd (in the same
+    round trip as its first EXECUTE) the first time a pooled connection sees
+    it and only EXECUTEd after that; the parse/plan survives across requests
+    for as long as the connection stays pooled. sql uses $1, $2, ...
+    placeholders.
+
+    If the session turns out not to have the statement (or already has it),
+    the connection's prepared names are reset and the statement is prepared
+    again, so the caller's query still succeeds. If that happens a second
+    time on the same connection, the server isn't keeping session state
+    between our transactions (a transaction-mode pooler rather than the
+    direct DATABASE_URL this expects), and the process runs every statement
+    unprepared from then on.
+    """
+    global _use_prepared
+    if not _use_prepared:
+        _execute_unprepared(cur, sql, params)
+        return
+    conn = cur.connection
+    prepared = _prepared.setdefault(conn, set())
+    had_savepoint = conn.info.transaction_status == TRANSACTION_STATUS_INTRANS
+    try:
+        _prepared_round_trip(cur, name, sql, params, prepare=name not in prepared, reset=False)
+        prepared.add(name)
+        return
+    except (errors.InvalidSqlStatementName, errors.DuplicatePreparedStatement):
+        _undo_failed_round_trip(cur, had_savepoint)
+
+    prepared.clear()
+    if conn not in _prepared_resets:
+        _prepared_resets.add(conn)
+        _prepared_round_trip(cur, name, sql, params, prepare=True, reset=True)
+        prepared.add(name)
+        return
+
+    _use_prepared = False
+    print(
+        "[WARN] Prepared statements aren't kept between transactions on this "
+        "DATABASE_URL (a pooler endpoint?); running queries unprepared"
+    )
+    _execute_unprepared(cur, sql, params)
+
+
 def ensure_schema():
     """
     Ensure users/subscriptions tables exist and migrate legacy schema if present.
+    Safe to call from several processes at once: the DDL is serialized behind
+    a transaction-scoped advisory lock.
     """
     with get_conn() as conn:
         with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_KEY,))
             cur.execute(
                 """
                 SELECT column_name
@@ -63,8 +288,8 @@ def ensure_schema():
                 """
                 CREATE TABLE IF NOT EXISTS subscriptions (
                     user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
-                    item_keywords TEXT NOT NULL,
-                    halls TEXT,
+                    item_keywords JSONB NOT NULL,
+                    halls JSONB,
                     last_notified_date DATE
                 );
                 """
@@ -114,12 +339,80 @@ def ensure_schema():
                 END $$;
                 """
             )
+            # Keywords/halls used to be JSON-encoded TEXT; store them as JSONB so
+            # psycopg2 hands back Python lists and merges can happen in SQL.
+            cur.execute(
+                """
+                DO $$
+                BEGIN
+                    IF EXISTS (
+                        SELECT 1 FROM information_schema.columns
+                        WHERE table_name = 'subscriptions'
+                          AND column_name = 'item_keywords'
+                          AND data_type = 'text'
+                    ) THEN
+                        ALTER TABLE subscriptions
+                            ALTER COLUMN item_keywords TYPE JSONB USING item_keywords::jsonb,
+                            ALTER COLUMN halls TYPE JSONB USING halls::jsonb;
+                    END IF;
+                END $$;
+                """
+            )
+            cur.execute(
+                """
+                CREATE OR REPLACE FUNCTION jsonb_array_union(a JSONB, b JSONB)
+                RETURNS JSONB
+                LANGUAGE sql IMMUTABLE
+                AS $$
+                    SELECT COALESCE(jsonb_agg(elem ORDER BY pos), '[]'::jsonb)
+                    FROM (
+                        SELECT DISTINCT ON (elem) elem, pos
+                        FROM jsonb_array_elements(
+                            COALESCE(a, '[]'::jsonb) || COALESCE(b, '[]'::jsonb)
+                        ) WITH ORDINALITY AS t(elem, pos)
+                        ORDER BY elem, pos
+                    ) merged
+                $$;
+                """
+            )
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS subscriptions_item_keywords_gin
+                ON subscriptions USING GIN (item_keywords jsonb_path_ops)
+                """
+            )
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS subscriptions_last_notified_date_idx
+                ON subscriptions (last_notified_date)
+                """
+            )
+            # Serves the login rate limiter's "links sent recently" lookup.
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS login_tokens_user_id_created_at_idx
+                ON login_tokens (user_id, created_at DESC)
+                """
+            )
+            # Let the expired-token sweeps range-scan instead of seq-scanning.
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS login_tokens_expires_at_idx
+                ON login_tokens (expires_at)
+                """
+            )
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS unsubscribe_tokens_expires_at_idx
+                ON unsubscribe_tokens (expires_at)
+                """
+            )
 
             if legacy_schema:
                 cur.execute(
                     """
                     INSERT INTO users (email)
-                    SELECT DISTINCT email FROM """
+                    SELECT DISTINCT lower(email) FROM """
                     + legacy_table
                     + """
                     ON CONFLICT (email) DO NOTHING
@@ -128,14 +421,109 @@ def ensure_schema():
                 cur.execute(
                     """
                     INSERT INTO subscriptions (user_id, item_keywords, halls, last_notified_date)
-                    SELECT u.id, s.item_keywords, s.halls, s.last_notified_date
+                    SELECT DISTINCT ON (u.id)
+                        u.id, s.item_keywords::jsonb, s.halls::jsonb, s.last_notified_date
                     FROM """
                     + legacy_table
                     + """ s
-                    JOIN users u ON u.email = s.email
+                    JOIN users u ON u.email = lower(s.email)
+                    ORDER BY u.id, s.last_notified_date DESC NULLS LAST
                     ON CONFLICT (user_id) DO UPDATE SET
                         item_keywords = EXCLUDED.item_keywords,
                         halls = EXCLUDED.halls,
                         last_notified_date = EXCLUDED.last_notified_date
                     """
                 )
+
+            _lowercase_user_emails(cur)
+
+
+def _lowercase_user_emails(cur) -> None:
+    """
+    Emails are stored lowercased (login_start normalizes them). Fix up older
+    rows where that can't collide, then enforce it with a case-insensitive
+    unique index once no case variants remain. Variants of one address are
+    left alone and reported, since merging their accounts needs a human.
+    """
+    cur.execute(
+        """
+        UPDATE users SET email = lower(email)
+        WHERE email <> lower(email)
+          AND lower(email) IN (
+              SELECT lower(email) FROM users GROUP BY 1 HAVING COUNT(*) = 1
+          )
+        """
+    )
+    cur.execute(
+        """
+        SELECT lower(email), array_agg(email ORDER BY email)
+        FROM users GROUP BY 1 HAVING COUNT(*) > 1
+        """
+    )
+    collisions = cur.fetchall()
+    for canonical, variants in collisions:
+        print(f"[WARN] Emails {', '.join(variants)} collide as {canonical}; left as is")
+    if not collisions:
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS users_email_lower_key ON users (lower(email))")
+
+
+def bulk_import_subscriptions(rows) -> int:
+    """
+    Load (email, keywords, halls) rows in one COPY into a staging table, then
+    merge them into users/subscriptions with two set-based statements instead
+    of a round trip per row. Keywords/halls are merged like /subscribe does.
+    Returns the number of subscriptions inserted or updated.
+    """
+    merged: dict[str, tuple[dict, dict]] = {}
+    for email, keywords, halls in rows:
+        email = email.strip().lower()
+        if not email:
+            continue
+        kw_seen, hall_seen = merged.setdefault(email, ({}, {}))
+        kw_seen.update(dict.fromkeys(keywords))
+        hall_seen.update(dict.fromkeys(halls or ()))
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for email, (keywords, halls) in merged.items():
+        writer.writerow(
+            [email, _dumps_json(list(keywords)), _dumps_json(list(halls)) if halls else None]
+        )
+    buf.seek(0)
+
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                CREATE TEMP TABLE subscription_import (
+                    email TEXT NOT NULL,
+                    item_keywords JSONB NOT NULL,
+                    halls JSONB
+                ) ON COMMIT DROP
+                """
+            )
+            cur.copy_expert("COPY subscription_import FROM STDIN WITH (FORMAT csv)", buf)
+            cur.execute(
+                """
+                INSERT INTO users (email)
+                SELECT email FROM subscription_import
+                ON CONFLICT (email) DO NOTHING
+                """
+            )
+            cur.execute(
+                """
+                INSERT INTO subscriptions (user_id, item_keywords, halls, last_notified_date)
+                SELECT u.id, i.item_keywords, i.halls, NULL
+                FROM subscription_import i
+                JOIN users u ON u.email = i.email
+                ON CONFLICT (user_id) DO UPDATE SET
+                    item_keywords = jsonb_array_union(
+                        subscriptions.item_keywords, EXCLUDED.item_keywords
+                    ),
+                    halls = NULLIF(
+                        jsonb_array_union(subscriptions.halls, EXCLUDED.halls),
+                        '[]'::jsonb
+                    )
+                """
+            )
+            return cur.rowcount
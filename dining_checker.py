@@ -1,5 +1,6 @@
 # dining_checker.py
 
+import atexit
 import os
 import smtplib
 import json
@@ -7,11 +8,16 @@ from email.message import EmailMessage
 from typing import Dict, List, Set
 from datetime import date
 import re
+import threading
+import time
 import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import orjson
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer, Tag
 from dotenv import load_dotenv
-from db import get_conn
+from db import execute_prepared, get_conn
 
 
 # ----------------------------
@@ -42,6 +48,7 @@ EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 EMAIL_FROM = os.getenv("EMAIL_FROM") or EMAIL_USER
 EMAIL_FROM_NAME = os.getenv("EMAIL_FROM_NAME") or "MIT Dining Alerts"
 MENU_CACHE_ENABLED = os.getenv("MENU_CACHE_ENABLED", "true").lower() == "true"
+MENU_MEMORY_CACHE_SECONDS = int(os.getenv("MENU_MEMORY_CACHE_SECONDS", "600"))
 
 
 # ----------------------------
@@ -51,29 +58,51 @@ MENU_CACHE_ENABLED = os.getenv("MENU_CACHE_ENABLED", "true").lower() == "true"
 def _get_cached_menu(hall: str, menu_date: date) -> str | None:
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT html FROM menu_cache
-                WHERE hall = %s AND menu_date = %s
-                """,
+            execute_prepared(
+                cur,
+                "get_cached_menu",
+                "SELECT html FROM menu_cache WHERE hall = $1 AND menu_date = $2",
                 (hall, menu_date),
             )
             row = cur.fetchone()
     return row[0] if row else None
 
 
+def _get_cached_menus(halls: list[str], menu_date: date) -> dict[str, str]:
+    """_get_cached_menu() for several halls in one query: {hall: html}."""
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            execute_prepared(
+                cur,
+                "get_cached_menus",
+                "SELECT hall, html FROM menu_cache WHERE hall = ANY($1) AND menu_date = $2",
+                (halls, menu_date),
+            )
+            return dict(cur.fetchall())
+
+
 def _set_cached_menu(hall: str, menu_date: date, payload: str) -> None:
     with get_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute(
+            execute_prepared(
+                cur,
+                "set_cached_menu",
                 """
                 INSERT INTO menu_cache (hall, menu_date, html)
-                VALUES (%s, %s, %s)
+                VALUES ($1, $2, $3)
                 ON CONFLICT (hall, menu_date) DO UPDATE
                 SET html = EXCLUDED.html, fetched_at = NOW()
                 """,
                 (hall, menu_date, payload),
             )
+            # Only today's page is ever read back, so drop this hall's older
+            # days rather than letting a copy of every page pile up.
+            execute_prepared(
+                cur,
+                "prune_cached_menu",
+                "DELETE FROM menu_cache WHERE hall = $1 AND menu_date < $2",
+                (hall, menu_date),
+            )
 
 
 def _build_menu_url_candidates(base_url: str, menu_date: date) -> list[str]:
@@ -86,13 +115,47 @@ def _build_menu_url_candidates(base_url: str, menu_date: date) -> list[str]:
     ]
 
 
+# One keep-alive session for every hall: they all live on the same host, so
+# later fetches skip the TCP/TLS handshake.
+_http = requests.Session()
+_http.headers["User-Agent"] = "jalapeno-poppers/1.0"
+
+# Hall pages are fetched concurrently; the work is all waiting on the network.
+_menu_pool = ThreadPoolExecutor(max_workers=len(DINING_URLS), thread_name_prefix="menu")
+
+
+# url -> (etag, last_modified, body) for conditional re-fetches. Pages that
+# did not parse into a menu are fetched again on every cache miss, and the
+# site answers those with a bodiless 304 when nothing changed.
+_HTTP_VALIDATOR_MAX_ENTRIES = 6 * len(DINING_URLS)
+_http_validators: dict[str, tuple[str | None, str | None, str]] = {}
+_http_validators_lock = threading.Lock()
+
+
 def _fetch_menu_url(url: str) -> str:
-    resp = requests.get(
-        url,
-        headers={"User-Agent": "jalapeno-poppers/1.0"},
-        timeout=15,
-    )
+    with _http_validators_lock:
+        known = _http_validators.get(url)
+    headers = {}
+    if known:
+        etag, last_modified, _ = known
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    resp = _http.get(url, headers=headers, timeout=15)
+    if resp.status_code == 304 and known:
+        return known[2]
     resp.raise_for_status()
+
+    etag = resp.headers.get("ETag")
+    last_modified = resp.headers.get("Last-Modified")
+    if etag or last_modified:
+        with _http_validators_lock:
+            _http_validators.pop(url, None)
+            _http_validators[url] = (etag, last_modified, resp.text)
+            while len(_http_validators) > _HTTP_VALIDATOR_MAX_ENTRIES:
+                del _http_validators[next(iter(_http_validators))]
     return resp.text
 
 
@@ -115,9 +178,32 @@ def fetch_menu(hall: str, url: str) -> str | None:
     return None
 
 
-def _load_today_menu(hall: str, url: str) -> tuple[dict[str, list[str]], str | None]:
-    today = date.today()
-    cached_html = _get_cached_menu(hall, today) if MENU_CACHE_ENABLED else None
+# (hall, date) -> (loaded_at, (items_by_meal, html)). Sits in front of the
+# Postgres menu_cache so repeat page views skip both the query and the parse.
+# Callers must treat the cached items as read-only.
+_menu_memory: dict[tuple[str, date], tuple[float, tuple[dict[str, list[str]], str | None]]] = {}
+_menu_memory_lock = threading.Lock()
+
+
+def _remembered_menu(hall: str, today: date) -> tuple[dict[str, list[str]], str | None] | None:
+    with _menu_memory_lock:
+        cached = _menu_memory.get((hall, today))
+    if cached and time.monotonic() - cached[0] < MENU_MEMORY_CACHE_SECONDS:
+        return cached[1]
+    return None
+
+
+def _remember_menu(hall: str, today: date, result: tuple[dict[str, list[str]], str | None]) -> None:
+    with _menu_memory_lock:
+        # Drop other days' entries as we go so the dict stays tiny.
+        for stale in [k for k in _menu_memory if k[1] != today]:
+            del _menu_memory[stale]
+        _menu_memory[(hall, today)] = (time.monotonic(), result)
+
+
+def _load_menu(
+    hall: str, url: str, today: date, cached_html: str | None
+) -> tuple[dict[str, list[str]], str | None]:
     if cached_html:
         items = _extract_items_by_meal(cached_html)
         if any(items.values()):
@@ -140,13 +226,68 @@ def _load_today_menu(hall: str, url: str) -> tuple[dict[str, list[str]], str | N
     return {}, last_html
 
 
+def _load_today_menus(halls_filter=None) -> dict[str, tuple[dict[str, list[str]], str | None]]:
+    """
+    Today's (items_by_meal, html) for every hall in halls_filter (default:
+    all), in DINING_URLS order. Halls in the in-process cache are answered
+    from it; the rest share one menu_cache query and are then parsed or
+    fetched in parallel.
+    """
+    if halls_filter:
+        allowed_halls = set(halls_filter)
+        halls = [hall for hall in DINING_URLS if hall in allowed_halls]
+    else:
+        halls = list(DINING_URLS)
+
+    today = date.today()
+    results: dict[str, tuple[dict[str, list[str]], str | None]] = {}
+    if MENU_CACHE_ENABLED:
+        for hall in halls:
+            remembered = _remembered_menu(hall, today)
+            if remembered is not None:
+                results[hall] = remembered
+
+    missing = [hall for hall in halls if hall not in results]
+    if missing:
+        cached_html = _get_cached_menus(missing, today) if MENU_CACHE_ENABLED else {}
+        loaded = _menu_pool.map(
+            lambda hall: _load_menu(hall, DINING_URLS[hall], today, cached_html.get(hall)),
+            missing,
+        )
+        for hall, result in zip(missing, loaded):
+            if MENU_CACHE_ENABLED and result[0]:
+                _remember_menu(hall, today, result)
+            results[hall] = result
+
+    return {hall: results[hall] for hall in halls}
+
+
+# After the ASCII fold only these 128 code points can remain: lowercase
+# letters, keep digits, and turn everything else into a separator.
+_NORMALIZE_TABLE = str.maketrans({
+    chr(cp): chr(cp).lower() if chr(cp).isalnum() else " " for cp in range(128)
+})
+
+
+# What NFKD + ASCII folding yields for each Latin-1/Latin Extended character
+# (jalapeño, crème brûlée, ...), so accented menu text skips the Unicode
+# database. Anything outside this range still takes the NFKD path.
+_LATIN_FOLD_TABLE = str.maketrans({
+    chr(cp): unicodedata.normalize("NFKD", chr(cp)).encode("ascii", "ignore").decode("ascii")
+    for cp in range(0x80, 0x250)
+})
+
+
+# Keywords and menu item names repeat across halls, subscribers and calls.
+@lru_cache(maxsize=4096)
 def _normalize_text(text: str) -> str:
     # Strip accents, lowercase, and normalize separators to spaces.
-    text = unicodedata.normalize("NFKD", text)
-    text = text.encode("ascii", "ignore").decode("ascii")
-    text = text.lower()
-    text = re.sub(r"[^a-z0-9]+", " ", text)
-    return " ".join(text.split())
+    if not text.isascii():
+        text = text.translate(_LATIN_FOLD_TABLE)
+        if not text.isascii():
+            text = unicodedata.normalize("NFKD", text)
+            text = text.encode("ascii", "ignore").decode("ascii")
+    return " ".join(text.translate(_NORMALIZE_TABLE).split())
 
 
 def _tokenize(text: str) -> list[str]:
@@ -154,15 +295,20 @@ def _tokenize(text: str) -> list[str]:
     return text.split() if text else []
 
 
-def _contains_sequence(tokens: list[str], phrase_tokens: list[str]) -> bool:
-    if not phrase_tokens:
-        return False
-    if len(phrase_tokens) > len(tokens):
-        return False
-    for i in range(len(tokens) - len(phrase_tokens) + 1):
-        if tokens[i : i + len(phrase_tokens)] == phrase_tokens:
-            return True
-    return False
+# The same handful of menu pages is checked for every subscriber, so keep the
+# extracted text of the most recent ones instead of re-parsing per call.
+# Only the text is needed here, so use lxml's C parser rather than html.parser.
+@lru_cache(maxsize=2 * len(DINING_URLS))
+def _page_tokens(html: str) -> list[str]:
+    soup = BeautifulSoup(html, "lxml")
+    return _tokenize(soup.get_text(separator=" "))
+
+
+@lru_cache(maxsize=2 * len(DINING_URLS))
+def _page_lines(html: str) -> list[str]:
+    soup = BeautifulSoup(html, "lxml")
+    lines = [ln.strip() for ln in soup.get_text(separator="\n").splitlines()]
+    return [ln for ln in lines if ln]
 
 
 def page_contains_any_keyword(html: str, keywords: list[str]) -> bool:
@@ -170,14 +316,49 @@ def page_contains_any_keyword(html: str, keywords: list[str]) -> bool:
     Return True if ANY of the keywords appears (case-insensitive)
     in the plain text of the page.
     """
-    soup = BeautifulSoup(html, "html.parser")
-    tokens = _tokenize(soup.get_text(separator=" "))
+    phrase_index = _cached_phrase_index(tuple(keywords))
+    if not phrase_index:
+        return False
+    return _has_phrase(_page_tokens(html), phrase_index)
+
+
+_MEAL_TAG_RE = re.compile(r"\[(.*?)\]")
+_MEAL_TAG_STRIP_RE = re.compile(r"\s*\[[^\]]+\]\s*")
+_NUTRITION_SUFFIX_RE = re.compile(r"\s*nutrition\s*\+\s*ingredients\s*$", re.IGNORECASE)
+_DAYPART_CLASS_RE = re.compile(r"site-panel--daypart", re.I)
+_DAYPART_CONTAINER_CLASS_RE = re.compile(r"site-panel__daypart-container", re.I)
+_DAYPART_TITLE_CLASS_RE = re.compile(r"site-panel__daypart-panel-title", re.I)
+_BAMCO_DAYPART_RE = re.compile(r"Bamco\.dayparts\['(\d+)'\]\s*=\s*(\{.*?\});", re.DOTALL)
+_STATE_BLOB_RES = tuple(
+    re.compile(pattern, re.DOTALL)
+    for pattern in (
+        r"window\.__PRELOADED_STATE__\s*=\s*({.*});",
+        r"window\.__INITIAL_STATE__\s*=\s*({.*});",
+        r"__NEXT_DATA__\s*=\s*({.*});",
+    )
+)
+
+
+_HEADING_TAGS = frozenset({"h1", "h2", "h3", "h4", "h5"})
 
-    for kw in keywords:
-        kw_tokens = _tokenize(kw)
-        if _contains_sequence(tokens, kw_tokens):
-            return True
-    return False
+
+def _previous_headings(root) -> dict[int, Tag | None]:
+    """
+    {id(tag): nearest h1-h5 before it in document order} for the whole
+    document root belongs to, i.e. what tag.find_previous(headings) returns,
+    computed in one walk instead of one backwards search per tag.
+    """
+    document = root
+    while document.parent is not None:
+        document = document.parent
+    previous: dict[int, Tag | None] = {}
+    last_heading = None
+    for node in document.descendants:
+        if isinstance(node, Tag):
+            previous[id(node)] = last_heading
+            if node.name in _HEADING_TAGS:
+                last_heading = node
+    return previous
 
 
 def _extract_items_by_meal_from_root(root) -> dict[str, list[str]]:
@@ -202,6 +383,8 @@ def _extract_items_by_meal_from_root(root) -> dict[str, list[str]]:
     if not item_elements:
         item_elements = root.select("li")
 
+    previous_headings = None
+
     for elem in item_elements:
         text = None
         classes = elem.get("class", []) if hasattr(elem, "get") else []
@@ -215,7 +398,7 @@ def _extract_items_by_meal_from_root(root) -> dict[str, list[str]]:
             continue
         meal = None
 
-        tag_match = re.search(r"\[(.*?)\]", text)
+        tag_match = _MEAL_TAG_RE.search(text)
         if tag_match:
             tag_text = tag_match.group(1).lower()
             if "br" in tag_text:
@@ -228,12 +411,14 @@ def _extract_items_by_meal_from_root(root) -> dict[str, list[str]]:
                 meal = "Dinner"
 
         # Clean display text after we parse tags.
-        text = re.sub(r"\s*\[[^\]]+\]\s*", " ", text)
-        text = re.sub(r"\s*nutrition\s*\+\s*ingredients\s*$", "", text, flags=re.IGNORECASE)
+        text = _MEAL_TAG_STRIP_RE.sub(" ", text)
+        text = _NUTRITION_SUFFIX_RE.sub("", text)
         text = " ".join(text.split())
 
         if not meal:
-            prev_heading = elem.find_previous(["h1", "h2", "h3", "h4", "h5"])
+            if previous_headings is None:
+                previous_headings = _previous_headings(root)
+            prev_heading = previous_headings.get(id(elem))
             if prev_heading:
                 heading_text = prev_heading.get_text(" ", strip=True).lower()
                 for label in meal_labels:
@@ -243,13 +428,13 @@ def _extract_items_by_meal_from_root(root) -> dict[str, list[str]]:
         if not meal:
             daypart_container = elem.find_parent(class_="site-panel__daypart")
             if not daypart_container:
-                daypart_container = elem.find_parent(class_=re.compile(r"site-panel--daypart", re.I))
+                daypart_container = elem.find_parent(class_=_DAYPART_CLASS_RE)
             if not daypart_container:
-                daypart_container = elem.find_parent(class_=re.compile(r"site-panel__daypart-container", re.I))
+                daypart_container = elem.find_parent(class_=_DAYPART_CONTAINER_CLASS_RE)
             if daypart_container:
                 daypart_title = daypart_container.find(
                     ["h1", "h2", "h3", "h4", "h5"],
-                    class_=re.compile(r"site-panel__daypart-panel-title", re.I),
+                    class_=_DAYPART_TITLE_CLASS_RE,
                 )
                 if daypart_title:
                     heading_text = daypart_title.get_text(" ", strip=True).lower()
@@ -263,11 +448,16 @@ def _extract_items_by_meal_from_root(root) -> dict[str, list[str]]:
     return items_by_meal
 
 
+_SCRIPT_STRAINER = SoupStrainer("script")
+
+
 def _extract_items_by_meal(html: str) -> dict[str, list[str]]:
     """
     Extract item labels grouped by meal/daypart from weekly-menu HTML.
     """
-    soup = BeautifulSoup(html, "html.parser")
+    # The embedded script data covers real pages, so parse just the <script>
+    # tags first and build the full tree only for the DOM fallback below.
+    scripts = BeautifulSoup(html, "lxml", parse_only=_SCRIPT_STRAINER).find_all("script")
 
     def _extract_items_from_bamco(script_text: str) -> dict[str, list[str]] | None:
         if "Bamco.menu_items" not in script_text or "Bamco.dayparts" not in script_text:
@@ -292,9 +482,9 @@ def _extract_items_by_meal(html: str) -> dict[str, list[str]]:
             return None
 
         dayparts = {}
-        for m in re.finditer(r"Bamco\.dayparts\['(\d+)'\]\s*=\s*(\{.*?\});", script_text, re.DOTALL):
+        for m in _BAMCO_DAYPART_RE.finditer(script_text):
             try:
-                dayparts[m.group(1)] = json.loads(m.group(2))
+                dayparts[m.group(1)] = orjson.loads(m.group(2))
             except Exception:
                 continue
 
@@ -315,7 +505,7 @@ def _extract_items_by_meal(html: str) -> dict[str, list[str]]:
         return items_by_meal if any(items_by_meal.values()) else None
 
     # MIT pages embed menu data in a Bamco JS object; prefer that.
-    for script in soup.find_all("script"):
+    for script in scripts:
         text = script.string or script.get_text() or ""
         items = _extract_items_from_bamco(text)
         if items:
@@ -389,37 +579,37 @@ def _extract_items_by_meal(html: str) -> dict[str, list[str]]:
             return None
         if text.startswith("{") and text.endswith("}"):
             try:
-                return json.loads(text)
+                return orjson.loads(text)
             except Exception:
                 return None
-        patterns = [
-            r"window\.__PRELOADED_STATE__\s*=\s*({.*});",
-            r"window\.__INITIAL_STATE__\s*=\s*({.*});",
-            r"__NEXT_DATA__\s*=\s*({.*});",
-        ]
-        for pattern in patterns:
-            m = re.search(pattern, text, re.DOTALL)
+        for pattern in _STATE_BLOB_RES:
+            m = pattern.search(text)
             if m:
                 try:
-                    return json.loads(m.group(1))
+                    return orjson.loads(m.group(1))
                 except Exception:
                     continue
         return None
 
-    for script in soup.find_all("script"):
+    for script in scripts:
         data = _try_parse_json(script.string or script.get_text())
         if data:
             items = _extract_items_from_json(data)
             if any(items.values()):
                 return items
 
+    soup = BeautifulSoup(html, "lxml")
     today_container = _find_today_container(date.today())
     root = today_container if today_container is not None else soup
     return _extract_items_by_meal_from_root(root)
 
 
-def extract_week_by_day(html: str) -> dict[str, dict[str, list[str]]]:
-    soup = BeautifulSoup(html, "html.parser")
+def extract_week_by_day(html: str, only_date: date | None = None) -> dict[str, dict[str, list[str]]]:
+    """
+    Items by meal for each data-date/data-day container on the page. With
+    only_date, containers labelled with another date are skipped.
+    """
+    soup = BeautifulSoup(html, "lxml")
     results: dict[str, dict[str, list[str]]] = {}
     containers = []
     for elem in soup.find_all(attrs={"data-date": True}):
@@ -431,13 +621,70 @@ def extract_week_by_day(html: str) -> dict[str, dict[str, list[str]]]:
         results["Unspecified"] = _extract_items_by_meal_from_root(soup)
         return results
 
+    only_iso = only_date.isoformat() if only_date else None
     for label, elem in containers:
+        if only_iso and only_iso not in label:
+            continue
         items = _extract_items_by_meal_from_root(elem)
         if items:
             results[label or "Unspecified"] = items
     return results
 
 
+def _build_phrase_index(keywords: list[str]) -> dict[str, list[tuple[str, int, str]]]:
+    """
+    Index keywords by their first token: {token: [(needle, position, keyword)]}
+    where needle is the phrase's tokens joined and padded with spaces.
+    Lets _match_phrases find every keyword in one pass over a token list
+    instead of one scan per keyword.
+    """
+    index: dict[str, list[tuple[str, int, str]]] = {}
+    for position, kw in enumerate(keywords):
+        phrase = _tokenize(kw)
+        if phrase:
+            index.setdefault(phrase[0], []).append((f" {' '.join(phrase)} ", position, kw))
+    return index
+
+
+# The same keyword lists are checked against every hall (and, in the app,
+# on every page view), so keep the built indexes around. Treat as read-only.
+@lru_cache(maxsize=256)
+def _cached_phrase_index(keywords: tuple[str, ...]) -> dict[str, list[tuple[str, int, str]]]:
+    return _build_phrase_index(list(keywords))
+
+
+def _padded(tokens: list[str]) -> str:
+    # Tokens never contain spaces, so a padded needle can only match whole
+    # tokens, and the sequence search runs in C instead of slicing lists.
+    return f" {' '.join(tokens)} "
+
+
+def _match_phrases(tokens: list[str], phrase_index) -> list[str]:
+    """Keywords from phrase_index that occur in tokens, in keyword order."""
+    found: dict[str, int] = {}
+    text = None
+    for token in set(tokens):
+        for needle, position, kw in phrase_index.get(token, ()):
+            if kw not in found:
+                if text is None:
+                    text = _padded(tokens)
+                if needle in text:
+                    found[kw] = position
+    return sorted(found, key=found.__getitem__)
+
+
+def _has_phrase(tokens: list[str], phrase_index) -> bool:
+    """True as soon as any keyword from phrase_index occurs in tokens."""
+    text = None
+    for token in set(tokens):
+        for needle, _, _ in phrase_index.get(token, ()):
+            if text is None:
+                text = _padded(tokens)
+            if needle in text:
+                return True
+    return False
+
+
 def _find_keyword_details_from_items(
     items_by_meal: dict[str, list[str]],
     keywords: list[str]
@@ -448,13 +695,12 @@ def _find_keyword_details_from_items(
     if not kw_list:
         return {}
 
+    phrase_index = _cached_phrase_index(tuple(kw_list))
     matches: Dict[str, Dict[str, Set[str]]] = {}
     for meal_label, items in items_by_meal.items():
         for item in items:
-            item_tokens = _tokenize(item)
-            for kw in kw_list:
-                if _contains_sequence(item_tokens, _tokenize(kw)):
-                    matches.setdefault(kw, {}).setdefault(item, set()).add(meal_label)
+            for kw in _match_phrases(_tokenize(item), phrase_index):
+                matches.setdefault(kw, {}).setdefault(item, set()).add(meal_label)
     return matches
 
 
@@ -471,35 +717,19 @@ def find_keyword_snippets(
     if not kw_list:
         return {}
 
-    if halls_filter:
-        allowed_halls = set(halls_filter)
-    else:
-        allowed_halls = set(DINING_URLS.keys())
-
+    phrase_index = _cached_phrase_index(tuple(kw_list))
     results: dict[str, list[str]] = {}
 
-    for hall, url in DINING_URLS.items():
-        if hall not in allowed_halls:
-            continue
-        items_by_meal, html = _load_today_menu(hall, url)
+    for hall, (items_by_meal, html) in _load_today_menus(halls_filter).items():
         if not items_by_meal and html:
             # Fallback: scan lines if menu items aren't detected
-            soup = BeautifulSoup(html, "html.parser")
-            lines = [ln.strip() for ln in soup.get_text(separator="\n").splitlines()]
-            lines = [ln for ln in lines if ln]
-            items_by_meal = {"Unspecified": lines}
+            items_by_meal = {"Unspecified": _page_lines(html)}
         if not items_by_meal:
             continue
         snippets: list[str] = []
         for items in items_by_meal.values():
             for item in items:
-                item_tokens = _tokenize(item)
-                matched = False
-                for kw in kw_list:
-                    if _contains_sequence(item_tokens, _tokenize(kw)):
-                        matched = True
-                        break
-                if matched and item not in snippets:
+                if item not in snippets and _has_phrase(_tokenize(item), phrase_index):
                     snippets.append(item)
                 if len(snippets) >= max_lines:
                     break
@@ -517,16 +747,9 @@ def get_today_menu_by_meal(
     max_items_per_meal: int = 30
 ) -> dict[str, dict[str, list[str]]]:
     allowed_meals = {"Breakfast", "Brunch", "Lunch", "Dinner"}
-    if halls_filter:
-        allowed_halls = set(halls_filter)
-    else:
-        allowed_halls = set(DINING_URLS.keys())
 
     results: dict[str, dict[str, list[str]]] = {}
-    for hall, url in DINING_URLS.items():
-        if hall not in allowed_halls:
-            continue
-        items_by_meal, _ = _load_today_menu(hall, url)
+    for hall, (items_by_meal, _) in _load_today_menus(halls_filter).items():
         if not items_by_meal:
             continue
         trimmed = {}
@@ -547,18 +770,9 @@ def find_item_locations(keywords: list[str], halls_filter = None) -> list[str]:
     Example:
         ["jalapeno"] -> ["Simmons Hall", "Maseeh Hall"]
     """
-    if halls_filter:
-        halls_to_check = {h for h in halls_filter}
-    else:
-        halls_to_check = set(DINING_URLS.keys())
-
     hits: list[str] = []
 
-    for hall, url in DINING_URLS.items():
-        if hall not in halls_to_check:
-            continue
-
-        items_by_meal, _ = _load_today_menu(hall, url)
+    for hall, (items_by_meal, _) in _load_today_menus(halls_filter).items():
         if _find_keyword_details_from_items(items_by_meal, keywords):
             hits.append(hall)
 
@@ -594,19 +808,9 @@ def find_keyword_details(
     if not kw_list:
         return {}
 
-    # Halls to check
-    if halls_filter:
-        allowed_halls = set(halls_filter)
-    else:
-        allowed_halls = set(DINING_URLS.keys())
-
     results: Dict[str, Dict[str, Set[str]]] = {}
 
-    for hall, url in DINING_URLS.items():
-        if hall not in allowed_halls:
-            continue
-
-        items_by_meal, _ = _load_today_menu(hall, url)
+    for hall, (items_by_meal, _) in _load_today_menus(halls_filter).items():
         hall_matches = _find_keyword_details_from_items(items_by_meal, kw_list)
 
         if hall_matches:
@@ -619,19 +823,13 @@ def find_keyword_details(
 # Email sending
 # ----------------------------
 
-def send_email(
+def build_email_message(
     to_email: str,
     subject: str,
     body: str,
     html_body: str | None = None,
     list_unsubscribe: str | None = None,
-) -> None:
-    """
-    Send a UTF-8 email using SMTP and an app password.
-    """
-    if not EMAIL_USER or not EMAIL_PASSWORD:
-        raise RuntimeError("EMAIL_USER or EMAIL_PASSWORD not set")
-
+) -> EmailMessage:
     msg = EmailMessage()
     msg["From"] = f"{EMAIL_FROM_NAME} <{EMAIL_FROM}>"
     msg["To"] = to_email
@@ -643,10 +841,153 @@ def send_email(
     msg.set_content(body)  # UTF-8 by default
     if html_body:
         msg.add_alternative(html_body, subtype="html")
+    return msg
+
 
-    with smtplib.SMTP(EMAIL_HOST, EMAIL_PORT, timeout=5) as server:
+def _smtp_connect() -> smtplib.SMTP:
+    if not EMAIL_USER or not EMAIL_PASSWORD:
+        raise RuntimeError("EMAIL_USER or EMAIL_PASSWORD not set")
+    server = smtplib.SMTP(EMAIL_HOST, EMAIL_PORT, timeout=5)
+    try:
         server.ehlo()
         server.starttls()
         server.ehlo()
         server.login(EMAIL_USER, EMAIL_PASSWORD)
-        server.send_message(msg)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+def _smtp_quit(server: smtplib.SMTP) -> None:
+    try:
+        server.quit()
+    except Exception:
+        server.close()
+
+
+# send_email() keeps one logged-in connection per thread (the app's email
+# workers) so the EHLO/STARTTLS/LOGIN handshake isn't paid on every message.
+SMTP_MAX_MESSAGES_PER_CONNECTION = 100
+_smtp_local = threading.local()
+_smtp_open: set[smtplib.SMTP] = set()
+_smtp_open_lock = threading.Lock()
+
+
+def _drop_thread_smtp(graceful: bool = False) -> None:
+    server = getattr(_smtp_local, "server", None)
+    _smtp_local.server = None
+    if server is not None:
+        with _smtp_open_lock:
+            _smtp_open.discard(server)
+        if graceful:
+            _smtp_quit(server)
+        else:
+            server.close()
+
+
+def _thread_smtp() -> tuple[smtplib.SMTP, bool]:
+    """This thread's SMTP connection, opening one if needed; also says whether it was reused."""
+    server = getattr(_smtp_local, "server", None)
+    if server is not None and _smtp_local.sent < SMTP_MAX_MESSAGES_PER_CONNECTION:
+        return server, True
+    if server is not None:
+        _drop_thread_smtp(graceful=True)
+    server = _smtp_connect()
+    _smtp_local.server = server
+    _smtp_local.sent = 0
+    with _smtp_open_lock:
+        _smtp_open.add(server)
+    return server, False
+
+
+@atexit.register
+def close_smtp_connections() -> None:
+    with _smtp_open_lock:
+        servers = list(_smtp_open)
+        _smtp_open.clear()
+    for server in servers:
+        _smtp_quit(server)
+
+
+def send_email(
+    to_email: str,
+    subject: str,
+    body: str,
+    html_body: str | None = None,
+    list_unsubscribe: str | None = None,
+) -> None:
+    """
+    Send a UTF-8 email using SMTP and an app password.
+    """
+    msg = build_email_message(to_email, subject, body, html_body, list_unsubscribe)
+    while True:
+        server, reused = _thread_smtp()
+        try:
+            server.send_message(msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            _drop_thread_smtp()
+            if reused:
+                # The server closed an idle connection; retry on a fresh one.
+                continue
+            raise
+        except smtplib.SMTPRecipientsRefused:
+            raise
+        except Exception:
+            _drop_thread_smtp()
+            raise
+        _smtp_local.sent += 1
+        return
+
+
+def _smtp_retryable(exc: Exception) -> bool:
+    """A dropped session or a temporary (4xx) reply; worth one more try."""
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in exc.recipients.values())
+    return isinstance(exc, smtplib.SMTPResponseException) and 400 <= exc.smtp_code < 500
+
+
+def send_email_batch(messages: list[EmailMessage]) -> list[EmailMessage]:
+    """
+    Send several messages over one SMTP session and return those that were
+    accepted. A message the server rejects outright is logged and skipped; a
+    dropped session or a temporary (4xx) reply gets it one retry on a fresh
+    session. If connecting or logging in fails, the rest of the batch is
+    abandoned rather than logging in again for every remaining message.
+    """
+    sent: list[EmailMessage] = []
+    server = None
+    try:
+        for i, msg in enumerate(messages):
+            for attempt in range(2):
+                if server is None:
+                    try:
+                        server = _smtp_connect()
+                    except RuntimeError:
+                        raise
+                    except Exception as e:
+                        print(f"[WARN] SMTP connect/login failed, {len(messages) - i} emails not sent: {e}")
+                        return sent
+                try:
+                    server.send_message(msg)
+                except Exception as e:
+                    transient = _smtp_retryable(e)
+                    retry = attempt == 0 and transient
+                    print(f"[WARN] Failed to send email to {msg['To']}{', retrying' if retry else ''}: {e}")
+                    # A permanently rejected message leaves the session usable;
+                    # anything else gets a fresh one.
+                    rejected = isinstance(e, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused))
+                    if transient or not rejected:
+                        server.close()
+                        server = None
+                    if retry:
+                        continue
+                else:
+                    sent.append(msg)
+                break
+    finally:
+        if server is not None:
+            _smtp_quit(server)
+    return sent
@@ -1,188 +1,281 @@
 # run_notifications.py
 
 import os
-import json
 import hashlib
+import signal
+import sys
+from html import escape
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date, datetime, timedelta
 from dotenv import load_dotenv
 
-from db import get_conn, ensure_schema
-from dining_checker import find_keyword_details, send_email
+from db import acquire_conn, ensure_schema, release_conn
+from dining_checker import build_email_message, find_keyword_details, send_email_batch
 load_dotenv()
 DEBUG_ALWAYS_NOTIFY = os.getenv("DEBUG_ALWAYS_NOTIFY", "false").lower() == "true"
 BASE_URL = os.getenv("BASE_URL", "").rstrip("/")
 UNSUBSCRIBE_TOKEN_TTL_DAYS = int(os.getenv("UNSUBSCRIBE_TOKEN_TTL_DAYS", "30"))
-
-
-def get_subscriptions():
+# Parallel SMTP sessions for the daily send; keep within the provider's limit.
+SMTP_CONCURRENCY = max(1, int(os.getenv("SMTP_CONCURRENCY", "4")))
+# Messages sent per SMTP session before that batch is recorded as notified.
+SMTP_BATCH_SIZE = 50
+# Rows pulled per round trip while streaming subscriptions.
+SUBSCRIPTION_FETCH_SIZE = 500
+
+# Fixed markup for the notification email; menu text, keywords and links are
+# escaped before being slotted in.
+_HTML_OPEN = "<div style=\"font-family: -apple-system, BlinkMacSystemFont, 'SF Pro Text', Arial, sans-serif; line-height: 1.5;\">"
+_HTML_CLOSE = "</div>"
+_HTML_HALL = "<h3 style=\"margin: 12px 0 6px;\">{}</h3><ul style=\"margin: 0 0 8px; padding-left: 18px;\">"
+_HTML_ITEM = "<li><strong>{}</strong> — <span style=\"color: #6b7280\">{}</span></li>"
+_HTML_UNSUBSCRIBE = "<p style=\"margin: 16px 0 0;\">Unsubscribe: <a href=\"{0}\">{0}</a></p>"
+
+
+def iter_subscriptions(conn, not_notified_on: date | None = None):
     """
-    Return list of (email, keywords_list, halls_list, last_notified_date)
-    from Postgres.
+    Yield (email, keywords_list, halls_list, last_notified_date) from
+    Postgres, streamed through a server-side cursor. Subscriptions with no
+    keywords are skipped. With not_notified_on, only subscriptions that
+    haven't been notified on or after that date are yielded.
     """
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT u.email, s.item_keywords, s.halls, s.last_notified_date
-                FROM subscriptions s
-                JOIN users u ON u.id = s.user_id
-                """
-            )
-            rows = cur.fetchall()
-
-    subs = []
-    for email, kw_json, halls_json, last_notified in rows:
-        try:
-            keywords = json.loads(kw_json) if kw_json else []
-        except Exception:
-            keywords = []
-
-        try:
-            halls = json.loads(halls_json) if halls_json else None
-        except Exception:
-            halls = None
-
-        subs.append((email, keywords, halls, last_notified))
-
-    return subs
-
-
-def update_last_notified(email: str, when: date):
+    sql = """
+        SELECT u.email, s.item_keywords, s.halls, s.last_notified_date
+        FROM subscriptions s
+        JOIN users u ON u.id = s.user_id
+        WHERE jsonb_array_length(s.item_keywords) > 0
+    """
+    params = ()
+    if not_notified_on is not None:
+        sql += " AND (s.last_notified_date IS NULL OR s.last_notified_date < %s)"
+        params = (not_notified_on,)
+    with conn:
+        # withhold lets the named cursor run on the autocommit pooled connection.
+        with conn.cursor(name="subscriptions", withhold=True) as cur:
+            cur.itersize = SUBSCRIPTION_FETCH_SIZE
+            cur.execute(sql, params)
+            for email, keywords, halls, last_notified in cur:
+                yield email, keywords, halls or None, last_notified
+
+
+def update_last_notified(conn, emails: list[str], when: date):
     """
-    Set last_notified_date for a given email.
+    Set last_notified_date for every given email in one statement.
     """
-    with get_conn() as conn:
+    if not emails:
+        return
+    with conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
-                UPDATE subscriptions
+                UPDATE subscriptions s
                 SET last_notified_date = %s
-                WHERE user_id = (SELECT id FROM users WHERE email = %s)
+                FROM users u
+                WHERE u.id = s.user_id AND u.email = ANY(%s)
                 """,
-                (when, email),
+                (when, emails),
             )
 
 
 def _hash_token(token: str) -> str:
-    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+    return hashlib.blake2b(token.encode("utf-8"), digest_size=32).hexdigest()
 
 
-def _create_unsubscribe_token_for_email(email: str) -> str | None:
-    if not BASE_URL:
-        return None
+def _create_unsubscribe_tokens(conn, emails: list[str]) -> dict[str, str]:
+    """
+    Create one unsubscribe token per email in a single INSERT and return
+    {email: token}. Emails without a user row are left out.
+    """
+    if not BASE_URL or not emails:
+        return {}
 
-    with get_conn() as conn:
+    tokens = {email: os.urandom(24).hex() for email in emails}
+    email_by_hash = {_hash_token(token): email for email, token in tokens.items()}
+    expires_at = datetime.utcnow() + timedelta(days=UNSUBSCRIBE_TOKEN_TTL_DAYS)
+    with conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-            row = cur.fetchone()
-            if not row:
-                return None
-            user_id = row[0]
-
-            token = os.urandom(24).hex()
-            token_hash = _hash_token(token)
-            expires_at = datetime.utcnow() + timedelta(days=UNSUBSCRIBE_TOKEN_TTL_DAYS)
             cur.execute(
                 """
                 INSERT INTO unsubscribe_tokens (token_hash, user_id, expires_at)
-                VALUES (%s, %s, %s)
+                SELECT t.token_hash, u.id, %s
+                FROM unnest(%s::text[], %s::text[]) AS t(email, token_hash)
+                JOIN users u ON u.email = t.email
+                RETURNING token_hash
                 """,
-                (token_hash, user_id, expires_at),
+                (expires_at, list(email_by_hash.values()), list(email_by_hash)),
             )
-            return token
+            created = cur.fetchall()
+    return {email_by_hash[token_hash]: tokens[email_by_hash[token_hash]] for (token_hash,) in created}
 
 
-def main():
-    ensure_schema()
-    today = date.today()
-    subscriptions = get_subscriptions()
+def _purge_expired_tokens(conn) -> None:
+    # The web app only sweeps occasionally; the daily run clears the rest.
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM login_tokens WHERE expires_at < NOW()")
+            cur.execute("DELETE FROM unsubscribe_tokens WHERE expires_at < NOW()")
 
-    for email, keywords, halls, last_notified in subscriptions:
-        # Clean up keywords: strip whitespace, drop empties
-        keywords = [k.strip() for k in keywords if k and k.strip()]
-        if not keywords:
+
+def _details_for_subscriber(all_details, keywords, halls):
+    """Narrow find_keyword_details() output for everyone down to one subscriber."""
+    details = {}
+    for hall, hall_matches in all_details.items():
+        if halls and hall not in halls:
             continue
+        mine = {kw: hall_matches[kw] for kw in keywords if kw in hall_matches}
+        if mine:
+            details[hall] = mine
+    return details
 
-        # Only send at most once per day per user
-        if not DEBUG_ALWAYS_NOTIFY:
-            if last_notified is not None and last_notified >= today:
-                continue
 
-        # Find detailed matches: hall -> keyword -> {meals}
-        details = find_keyword_details(keywords, halls_filter=halls)
+def _match_rows(details):
+    """
+    Yield (hall, [(item, "Meal, Meal")]) sorted by hall and item. An item
+    matched by several keywords is listed once.
+    """
+    for hall_name in sorted(details):
+        meals_by_item = {}
+        for item_meals in details[hall_name].values():
+            for item_name, meals in item_meals.items():
+                meals_by_item.setdefault(item_name, set()).update(meals)
+        yield hall_name, [(item, ", ".join(sorted(meals))) for item, meals in sorted(meals_by_item.items())]
 
-        if not details:
-            continue
 
-        lines = [
-            f"MIT Dining Alerts — {today.isoformat()}",
-            "",
-            f"Magic words: {', '.join(keywords)}",
-            "",
-            "Matches:",
-        ]
+def _render_matches(today_iso, keywords, details):
+    """
+    Text and HTML bodies listing one subscriber's matches, without the
+    unsubscribe footer. The HTML is left open (no closing outer </div>) so
+    the footer can be appended.
+    """
+    magic_words = ", ".join(keywords)
+    lines = [
+        f"MIT Dining Alerts — {today_iso}",
+        "",
+        f"Magic words: {magic_words}",
+        "",
+        "Matches:",
+    ]
+    html_lines = [
+        _HTML_OPEN,
+        f"<h2 style=\"margin: 0 0 8px;\">MIT Dining Alerts — {today_iso}</h2>",
+        f"<p style=\"margin: 0 0 12px; color: #6b7280;\">Magic words: {escape(magic_words)}</p>",
+        "<div>",
+    ]
+
+    # Example structure in email:
+    # Simmons Hall:
+    #   - Jalapeno Poppers — Lunch, Dinner
+    #   - Shrimp Tacos — Dinner
+    for hall_name, items in _match_rows(details):
+        lines.append(f"{hall_name}:")
+        html_lines.append(_HTML_HALL.format(escape(hall_name)))
+        for item_name, meal_str in items:
+            lines.append(f"  - {item_name} — {meal_str}")
+            html_lines.append(_HTML_ITEM.format(escape(item_name), escape(meal_str)))
+        lines.append("")  # blank line between halls
+        html_lines.append("</ul>")
+    html_lines.append("</div>")
+    return "\n".join(lines), "".join(html_lines)
 
-        # Example structure in email:
-        # Simmons Hall:
-        #   - jalapeno — Lunch, Dinner
-        #   - shrimp — Dinner
-        for hall_name in sorted(details.keys()):
-            hall_data = details[hall_name]
-            lines.append(f"{hall_name}:")
 
-            for kw in sorted(hall_data.keys()):
-                for item_name, meals in sorted(hall_data[kw].items()):
-                    meal_str = ", ".join(sorted(meals))
-                    lines.append(f"  - {item_name} — {meal_str}")
+def main():
+    # A stopped job (e.g. a cancelled workflow) gets SIGTERM; exit through
+    # Python so _notify still records who was already sent.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    ensure_schema()
+    # One pooled connection serves every query in the run.
+    conn = acquire_conn()
+    try:
+        _notify(conn)
+    finally:
+        release_conn(conn)
 
-            lines.append("")  # blank line between halls
 
+def _notify(conn):
+    _purge_expired_tokens(conn)
+    today = date.today()
+    # Only send at most once per day per user
+    subscriptions = iter_subscriptions(conn, None if DEBUG_ALWAYS_NOTIFY else today)
 
-        unsubscribe_token = _create_unsubscribe_token_for_email(email)
+    due = []
+    for email, keywords, halls, _ in subscriptions:
+        # Clean up keywords: strip whitespace, drop empties
+        keywords = [k.strip() for k in keywords if k and k.strip()]
+        if not keywords:
+            continue
+
+        due.append((email, keywords, halls))
+
+    if not due:
+        return
+
+    # One multi-keyword pass over the menus covers every subscriber; each
+    # user's matches are then picked out of the shared result.
+    wanted_halls = None
+    if all(halls for _, _, halls in due):
+        wanted_halls = {hall for _, _, halls in due for hall in halls}
+    all_details = find_keyword_details(
+        [kw for _, keywords, _ in due for kw in keywords],
+        halls_filter=wanted_halls,
+    )
+
+    # Subscribers with the same keywords and halls get the same matches, so
+    # render each combination once and only add the per-user unsubscribe link.
+    today_iso = today.isoformat()
+    subject = "MIT Dining Alerts — today’s matches"
+    rendered_by_key = {}
+    matched = []
+    for email, keywords, halls in due:
+        key = (tuple(keywords), tuple(halls) if halls else None)
+        if key not in rendered_by_key:
+            # Find detailed matches: hall -> keyword -> {item: {meals}}
+            details = _details_for_subscriber(all_details, keywords, halls)
+            rendered_by_key[key] = _render_matches(today_iso, keywords, details) if details else None
+        if rendered_by_key[key] is not None:
+            matched.append((email, rendered_by_key[key]))
+
+    unsubscribe_tokens = _create_unsubscribe_tokens(conn, [email for email, _ in matched])
+    outbox = []
+    for email, (body, html_body) in matched:
+        unsubscribe_token = unsubscribe_tokens.get(email)
         unsubscribe_link = (
             f"{BASE_URL}/unsubscribe/confirm?token={unsubscribe_token}"
             if unsubscribe_token
             else None
         )
-        if unsubscribe_token:
-            lines.extend(
-                [
-                    "",
-                    "Unsubscribe:",
-                    unsubscribe_link,
-                ]
-            )
-
-        body = "\n".join(lines)
-        subject = "MIT Dining Alerts — today’s matches"
-        html_lines = []
-        html_lines.append("<div style=\"font-family: -apple-system, BlinkMacSystemFont, 'SF Pro Text', Arial, sans-serif; line-height: 1.5;\">")
-        html_lines.append(f"<h2 style=\"margin: 0 0 8px;\">MIT Dining Alerts — {today.isoformat()}</h2>")
-        html_lines.append(f"<p style=\"margin: 0 0 12px; color: #6b7280;\">Magic words: {', '.join(keywords)}</p>")
-        html_lines.append("<div>")
-        for hall_name in sorted(details.keys()):
-            hall_data = details[hall_name]
-            html_lines.append(f"<h3 style=\"margin: 12px 0 6px;\">{hall_name}</h3>")
-            html_lines.append("<ul style=\"margin: 0 0 8px; padding-left: 18px;\">")
-            for kw in sorted(hall_data.keys()):
-                for item_name, meals in sorted(hall_data[kw].items()):
-                    meal_str = ", ".join(sorted(meals))
-                    html_lines.append(f"<li><strong>{item_name}</strong> — <span style=\"color: #6b7280\">{meal_str}</span></li>")
-            html_lines.append("</ul>")
-        html_lines.append("</div>")
         if unsubscribe_link:
-            html_lines.append(
-                f"<p style=\"margin: 16px 0 0;\">Unsubscribe: <a href=\"{unsubscribe_link}\">{unsubscribe_link}</a></p>"
+            body += f"\n\nUnsubscribe:\n{unsubscribe_link}"
+            html_body += _HTML_UNSUBSCRIBE.format(escape(unsubscribe_link))
+        html_body += _HTML_CLOSE
+
+        outbox.append(
+            (
+                email,
+                build_email_message(
+                    email, subject, body, html_body=html_body, list_unsubscribe=unsubscribe_link
+                ),
             )
-        html_lines.append("</div>")
-        html_body = "".join(html_lines)
-
-        send_email(email, subject, body, html_body=html_body,
-                   list_unsubscribe=unsubscribe_link)
-
-        # Mark as notified today
-        update_last_notified(email, today)
+        )
 
+    # Spread the outbox over a few SMTP sessions so their round trips overlap.
+    # Each batch is recorded as soon as it finishes (only the people actually
+    # sent), so a run that dies part-way re-sends at most what was in flight.
+    email_by_msg = {id(msg): email for email, msg in outbox}
+    messages = [msg for _, msg in outbox]
+    batches = [messages[i : i + SMTP_BATCH_SIZE] for i in range(0, len(messages), SMTP_BATCH_SIZE)]
+    pool = ThreadPoolExecutor(max_workers=min(SMTP_CONCURRENCY, len(batches)) or 1)
+    futures = [pool.submit(send_email_batch, batch) for batch in batches]
+    recorded = set()
+    try:
+        for future in as_completed(futures):
+            recorded.add(future)
+            update_last_notified(conn, [email_by_msg[id(msg)] for msg in future.result()], today)
+    finally:
+        # Failing or being stopped: start no new batches, but still record
+        # the ones that finish.
+        pool.shutdown(cancel_futures=True)
+        for future in futures:
+            if future not in recorded and not future.cancelled() and future.exception() is None:
+                update_last_notified(conn, [email_by_msg[id(msg)] for msg in future.result()], today)
 
 if __name__ == "__main__":
     main()
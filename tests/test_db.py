@@ -0,0 +1,228 @@
+import os
+import weakref
+from datetime import date
+
+import psycopg2
+import pytest
+
+import db
+from db import _lowercase_user_emails, acquire_conn, execute_prepared, get_conn, release_conn
+from dining_checker import _get_cached_menu, _get_cached_menus, _set_cached_menu
+
+
+def _connect():
+    try:
+        return psycopg2.connect(os.environ["DATABASE_URL"])
+    except psycopg2.Error:
+        pytest.skip("no Postgres reachable at DATABASE_URL")
+
+
+@pytest.fixture
+def cur():
+    """A cursor in a transaction that is rolled back afterwards; needs a real DATABASE_URL."""
+    conn = _connect()
+    try:
+        with conn.cursor() as cur:
+            # Temp tables shadow the real ones for the rest of the transaction.
+            cur.execute(
+                """
+                CREATE TEMP TABLE users (
+                    id SERIAL PRIMARY KEY,
+                    email TEXT UNIQUE NOT NULL
+                ) ON COMMIT DROP
+                """
+            )
+            yield cur
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def _emails(cur):
+    cur.execute("SELECT email FROM users ORDER BY id")
+    return [row[0] for row in cur.fetchall()]
+
+
+def _has_lower_index(cur):
+    cur.execute("SELECT to_regclass('pg_temp.users_email_lower_key')")
+    return cur.fetchone()[0] is not None
+
+
+def test_lowercase_user_emails_skips_case_duplicates(cur, capsys):
+    cur.execute("INSERT INTO users (email) VALUES ('Foo@x.com'), ('FOO@x.com'), ('Bar@x.com')")
+
+    _lowercase_user_emails(cur)
+
+    assert _emails(cur) == ["Foo@x.com", "FOO@x.com", "bar@x.com"]
+    assert not _has_lower_index(cur)
+    assert "FOO@x.com, Foo@x.com collide as foo@x.com" in capsys.readouterr().out
+
+
+def test_lowercase_user_emails_adds_index_without_duplicates(cur):
+    cur.execute("INSERT INTO users (email) VALUES ('Foo@x.com'), ('bar@x.com')")
+
+    _lowercase_user_emails(cur)
+
+    assert _emails(cur) == ["foo@x.com", "bar@x.com"]
+    assert _has_lower_index(cur)
+
+
+@pytest.fixture
+def autocommit_cur():
+    conn = _connect()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            yield cur
+    finally:
+        conn.close()
+
+
+@pytest.fixture(autouse=True)
+def _prepared_statements_on(monkeypatch):
+    monkeypatch.setattr(db, "_use_prepared", True)
+    monkeypatch.setattr(db, "_prepared_resets", weakref.WeakSet())
+
+
+def test_execute_prepared_reprepares_when_session_lost_statement(autocommit_cur):
+    execute_prepared(autocommit_cur, "test_add", "SELECT $1::int + 1", (1,))
+    # The session lost it (e.g. DISCARD ALL) while we still think it's there.
+    autocommit_cur.execute("DEALLOCATE ALL")
+
+    execute_prepared(autocommit_cur, "test_add", "SELECT $1::int + 1", (2,))
+    assert autocommit_cur.fetchone() == (3,)
+    assert db._use_prepared is True
+
+    execute_prepared(autocommit_cur, "test_add", "SELECT $1::int + 1", (5,))
+    assert autocommit_cur.fetchone() == (6,)
+
+
+def test_execute_prepared_tolerates_statement_it_forgot(autocommit_cur):
+    execute_prepared(autocommit_cur, "test_add", "SELECT $1::int + 1", (1,))
+    db._prepared[autocommit_cur.connection].clear()
+
+    execute_prepared(autocommit_cur, "test_add", "SELECT $1::int + 1", (4,))
+
+    assert autocommit_cur.fetchone() == (5,)
+    assert db._use_prepared is True
+
+
+def test_execute_prepared_recovers_inside_a_transaction(autocommit_cur):
+    conn = autocommit_cur.connection
+    autocommit_cur.execute("CREATE TEMP TABLE seen (x INT)")
+    execute_prepared(autocommit_cur, "test_add", "SELECT $1::int + 1", (1,))
+
+    with conn:
+        autocommit_cur.execute("INSERT INTO seen VALUES (1)")
+        autocommit_cur.execute("DEALLOCATE ALL")
+        execute_prepared(autocommit_cur, "test_add", "SELECT $1::int + 1", (2,))
+        assert autocommit_cur.fetchone() == (3,)
+        autocommit_cur.execute("INSERT INTO seen VALUES (2)")
+
+    # The same, when the lookup is the transaction's first statement.
+    autocommit_cur.execute("DEALLOCATE ALL")
+    db._prepared_resets.discard(conn)
+    with conn:
+        execute_prepared(autocommit_cur, "test_add", "SELECT $1::int + 1", (3,))
+        assert autocommit_cur.fetchone() == (4,)
+        autocommit_cur.execute("INSERT INTO seen VALUES (3)")
+
+    autocommit_cur.execute("SELECT array_agg(x ORDER BY x) FROM seen")
+    assert autocommit_cur.fetchone() == ([1, 2, 3],)
+    assert db._use_prepared is True
+
+
+def test_execute_prepared_goes_unprepared_when_statements_keep_vanishing(autocommit_cur):
+    for value in (1, 2, 3):
+        # What a transaction-mode pooler looks like: another backend each time.
+        autocommit_cur.execute("DEALLOCATE ALL")
+        execute_prepared(autocommit_cur, "test_add", "SELECT $1::int + 1", (value,))
+        assert autocommit_cur.fetchone() == (value + 1,)
+
+    assert db._use_prepared is False
+
+
+def test_unprepared_fallback_maps_dollar_placeholders(autocommit_cur):
+    db._use_prepared = False
+
+    execute_prepared(autocommit_cur, "test_sub", "SELECT $2::int - $1::int, $1::int, '100%'", (1, 5))
+
+    assert autocommit_cur.fetchone() == (4, 1, "100%")
+
+
+def test_menu_cache_statements_survive_lost_session_state():
+    conn = _connect()
+    with conn, conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('public.menu_cache')")
+        has_table = cur.fetchone()[0] is not None
+    conn.close()
+    if not has_table:
+        pytest.skip("schema not initialized (run flask init-db)")
+
+    day = date(2000, 1, 1)
+    try:
+        _set_cached_menu("Test Hall", day, "<p>menu</p>")
+        assert _get_cached_menu("Test Hall", day) == "<p>menu</p>"
+        assert _get_cached_menus(["Test Hall"], day) == {"Test Hall": "<p>menu</p>"}
+        with get_conn() as pooled, pooled.cursor() as cur:
+            cur.execute("DEALLOCATE ALL")
+        # Each helper re-prepares on the connection and still succeeds.
+        assert _get_cached_menu("Test Hall", day) == "<p>menu</p>"
+        assert _get_cached_menus(["Test Hall"], day) == {"Test Hall": "<p>menu</p>"}
+        _set_cached_menu("Test Hall", day, "<p>new</p>")
+        assert _get_cached_menu("Test Hall", day) == "<p>new</p>"
+        assert db._use_prepared is True
+    finally:
+        with get_conn() as pooled, pooled.cursor() as cur:
+            cur.execute("DELETE FROM menu_cache WHERE hall = 'Test Hall'")
+
+
+def test_get_conn_reuses_the_threads_idle_connection():
+    _connect().close()
+
+    outer = acquire_conn()
+    try:
+        with get_conn() as inner:
+            assert inner is outer
+        with outer:
+            with outer.cursor() as cur:
+                cur.execute("SELECT 1")
+            # An open transaction on the held connection isn't joined.
+            with get_conn() as inner:
+                assert inner is not outer
+    finally:
+        release_conn(outer)
+
+
+def test_pool_keeps_connections_beyond_pool_min():
+    _connect().close()
+
+    def backend_pids():
+        conns = [acquire_conn() for _ in range(db.PG_POOL_MIN + 2)]
+        try:
+            pids = set()
+            for conn in conns:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_backend_pid()")
+                    pids.add(cur.fetchone()[0])
+            return pids
+        finally:
+            for conn in conns:
+                release_conn(conn)
+
+    first = backend_pids()
+    # Every connection handed back was kept, so no new backends are needed.
+    assert backend_pids() == first
+
+
+def test_release_forgets_connections_the_pool_discards(monkeypatch):
+    _connect().close()
+
+    conn = acquire_conn()
+    tracked = len(db._last_used)
+    # Make the pool close this one on the way back instead of keeping it.
+    monkeypatch.setattr(db._get_pool(), "minconn", 0)
+    release_conn(conn)
+
+    assert conn.closed
+    assert len(db._last_used) == tracked
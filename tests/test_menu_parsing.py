@@ -1,27 +1,198 @@
+import random
+import re
+import unicodedata
+from datetime import date
 from pathlib import Path
 
-from dining_checker import _extract_items_by_meal, _find_keyword_details_from_items
+import pytest
+from bs4 import BeautifulSoup
+
+from dining_checker import (
+    _HEADING_TAGS,
+    _build_phrase_index,
+    _extract_items_by_meal,
+    _find_keyword_details_from_items,
+    _match_phrases,
+    _normalize_text,
+    _previous_headings,
+    _tokenize,
+    extract_week_by_day,
+    page_contains_any_keyword,
+)
 
 
 FIXTURE_PATH = Path(__file__).parent / "fixtures" / "menu_sample.html"
+HEADINGS_FIXTURE_PATH = Path(__file__).parent / "fixtures" / "menu_headings.html"
+WEEK_FIXTURE_PATH = Path(__file__).parent / "fixtures" / "menu_week.html"
 
 
-def _load_fixture():
-    return FIXTURE_PATH.read_text(encoding="utf-8")
+@pytest.fixture(scope="module")
+def items():
+    return _extract_items_by_meal(FIXTURE_PATH.read_text(encoding="utf-8"))
 
 
-def test_extract_items_by_meal():
-    html = _load_fixture()
-    items = _extract_items_by_meal(html)
+def test_extract_items_by_meal(items):
     assert "Breakfast" in items
     assert "Brunch" in items
     assert "Jalapeno Poppers" in items["Breakfast"]
     assert "Shrimp Tacos" in items["Brunch"]
 
 
-def test_find_keyword_details_from_items():
-    html = _load_fixture()
-    items = _extract_items_by_meal(html)
+def test_find_keyword_details_from_items(items):
     matches = _find_keyword_details_from_items(items, ["jalapeno poppers", "shrimp"])
-    assert matches["jalapeno poppers"] == {"Breakfast"}
-    assert matches["shrimp"] == {"Brunch"}
+    assert matches["jalapeno poppers"] == {"Jalapeno Poppers": {"Breakfast"}}
+    assert matches["shrimp"] == {"Shrimp Tacos": {"Brunch"}}
+
+
+def test_items_take_meal_from_nearest_heading_or_daypart():
+    items = _extract_items_by_meal(HEADINGS_FIXTURE_PATH.read_text(encoding="utf-8"))
+    assert items == {
+        # Only a non-meal page heading precedes it.
+        "Unspecified": ["Coffee"],
+        # Station heading "Grill" has no meal; the daypart panel title does.
+        # "Pasta" carries its own [L] tag.
+        "Lunch": ["Cheeseburger", "Pasta"],
+        "Breakfast": ["Waffles"],
+        # The heading sits inside an earlier sibling's subtree.
+        "Dinner": ["Jalapeno Poppers"],
+        # The item is inside the heading itself.
+        "Brunch": ["Brunch Burrito"],
+    }
+
+
+def test_extract_week_by_day_keeps_only_the_requested_day():
+    html = WEEK_FIXTURE_PATH.read_text(encoding="utf-8")
+
+    assert extract_week_by_day(html) == {
+        "2026-10-15": {"Lunch": ["Jalapeno Poppers"]},
+        "Friday 2026-10-16": {"Dinner": ["Shrimp Tacos"]},
+    }
+    assert extract_week_by_day(html, only_date=date(2026, 10, 15)) == {
+        "2026-10-15": {"Lunch": ["Jalapeno Poppers"]},
+    }
+    # data-day labels only need to contain the ISO date.
+    assert extract_week_by_day(html, only_date=date(2026, 10, 16)) == {
+        "Friday 2026-10-16": {"Dinner": ["Shrimp Tacos"]},
+    }
+    assert extract_week_by_day(html, only_date=date(2026, 10, 17)) == {}
+
+
+def test_previous_headings_matches_find_previous():
+    soup = BeautifulSoup(HEADINGS_FIXTURE_PATH.read_text(encoding="utf-8"), "lxml")
+    previous = _previous_headings(soup.body)
+    for tag in soup.find_all(True):
+        assert previous[id(tag)] is tag.find_previous(sorted(_HEADING_TAGS)), tag
+
+
+def _normalize_text_nfkd(text):
+    # The original implementation the translate tables stand in for.
+    text = unicodedata.normalize("NFKD", text)
+    text = text.encode("ascii", "ignore").decode("ascii")
+    text = text.lower()
+    text = re.sub(r"[^a-z0-9]+", " ", text)
+    return " ".join(text.split())
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "Jalapeño Poppers",
+        "Crème Brûlée",
+        "PAELLA À LA VALENCIANA",
+        "Łosoś z grilla, Ærøskøbing Œufs",
+        "Straße",
+        "ﬁsh & ﬂatbread",
+        "Cheese™ Pizza ½ off",
+        "ＦＵＬＬＷＩＤＴＨ Tofu",
+        "cafe\u0301 au lait",
+        "Mac-n-Cheese (V, GF) -- 320 cal.",
+        "  tabs\tand\nnewlines  ",
+        "“Chef’s” special — today…",
+        "",
+    ],
+)
+def test_normalize_text_matches_nfkd(text):
+    assert _normalize_text(text) == _normalize_text_nfkd(text)
+
+
+def test_normalize_text_matches_nfkd_per_character():
+    for cp in range(0x3000):
+        text = f"a{chr(cp)}b"
+        assert _normalize_text(text) == _normalize_text_nfkd(text), hex(cp)
+
+
+def _find_keyword_details_one_by_one(items_by_meal, keywords):
+    # The original matcher: every keyword's tokens slid over every item.
+    def contains(tokens, phrase):
+        return bool(phrase) and any(
+            tokens[i : i + len(phrase)] == phrase for i in range(len(tokens) - len(phrase) + 1)
+        )
+
+    matches = {}
+    for meal_label, items in items_by_meal.items():
+        for item in items:
+            for kw in dict.fromkeys(k.strip() for k in keywords if k and k.strip()):
+                if contains(_tokenize(item), _tokenize(kw)):
+                    matches.setdefault(kw, {}).setdefault(item, set()).add(meal_label)
+    return matches
+
+
+MATCHER_ITEMS = {
+    "Lunch": ["Spicy Jalapeño Poppers!", "Popcorn Shrimp", "Shrimp & Grits"],
+    "Dinner": ["Jalapeno Poppers", "Poppers, Jalapeno", "Shrimp & Grits"],
+}
+
+
+def test_keywords_match_whole_tokens_in_order():
+    matches = _find_keyword_details_from_items(
+        MATCHER_ITEMS, ["jalapeno poppers", "pop", "shrimp", "grits shrimp"]
+    )
+    assert matches == {
+        "jalapeno poppers": {"Spicy Jalapeño Poppers!": {"Lunch"}, "Jalapeno Poppers": {"Dinner"}},
+        "shrimp": {"Popcorn Shrimp": {"Lunch"}, "Shrimp & Grits": {"Lunch", "Dinner"}},
+    }
+
+
+def test_keywords_that_normalize_alike_are_reported_separately():
+    matches = _find_keyword_details_from_items(
+        MATCHER_ITEMS, ["Jalapeno", "jalapeño", " Jalapeno ", "JALAPENO", "  "]
+    )
+    expected_items = {
+        "Spicy Jalapeño Poppers!": {"Lunch"},
+        "Jalapeno Poppers": {"Dinner"},
+        "Poppers, Jalapeno": {"Dinner"},
+    }
+    assert matches == {kw: expected_items for kw in ["Jalapeno", "jalapeño", "JALAPENO"]}
+
+
+def test_match_phrases_returns_keyword_order():
+    index = _build_phrase_index(["jalapeno", "tacos", "taco", "shrimp tacos", "fish tacos"])
+    assert _match_phrases(_tokenize("Shrimp Tacos with Jalapeno"), index) == [
+        "jalapeno",
+        "tacos",
+        "shrimp tacos",
+    ]
+
+
+def test_page_contains_any_keyword():
+    html = "<html><body><h3>Lunch</h3><ul><li>Jalapeño&nbsp;Poppers</li></ul></body></html>"
+    assert page_contains_any_keyword(html, ["tofu", "jalapeno poppers"])
+    assert not page_contains_any_keyword(html, ["poppers jalapeno"])
+    assert not page_contains_any_keyword(html, ["  ", "lunch jalapeno poppers tofu"])
+    assert not page_contains_any_keyword(html, [])
+
+
+def test_keyword_matching_agrees_with_one_by_one_matching():
+    words = ["jalapeno", "jalapeño", "poppers", "shrimp", "tacos", "fried", "rice", "&", "mac-n-cheese"]
+    rng = random.Random(0)
+    for _ in range(500):
+        items = {
+            meal: [" ".join(rng.choices(words, k=rng.randint(1, 5))) for _ in range(4)]
+            for meal in ("Breakfast", "Lunch")
+        }
+        keywords = [" ".join(rng.choices(words, k=rng.randint(1, 3))) for _ in range(rng.randint(1, 4))]
+        keywords.append(keywords[0].upper())
+        expected = _find_keyword_details_one_by_one(items, keywords)
+        matches = _find_keyword_details_from_items(items, keywords)
+        assert matches == expected
+        assert list(matches) == list(expected)
@@ -0,0 +1,45 @@
+from run_notifications import _HTML_CLOSE, _HTML_ITEM, _render_matches
+
+
+DETAILS = {
+    "Simmons Hall": {
+        "poppers": {"Jalapeno <Poppers>": {"Lunch", "Dinner"}},
+        "jalapeno": {"Jalapeno <Poppers>": {"Breakfast"}, "Jalapeno Cornbread": {"Dinner"}},
+    },
+    "Baker House": {
+        "rice": {"Fried Rice & Beans": {"Lunch"}},
+    },
+}
+
+
+def test_render_matches_text_lists_each_item_once_sorted():
+    body, _ = _render_matches("2026-10-15", ["poppers", "jalapeno", "rice"], DETAILS)
+    assert body == "\n".join(
+        [
+            "MIT Dining Alerts — 2026-10-15",
+            "",
+            "Magic words: poppers, jalapeno, rice",
+            "",
+            "Matches:",
+            "Baker House:",
+            "  - Fried Rice & Beans — Lunch",
+            "",
+            "Simmons Hall:",
+            "  - Jalapeno <Poppers> — Breakfast, Dinner, Lunch",
+            "  - Jalapeno Cornbread — Dinner",
+            "",
+        ]
+    )
+
+
+def test_render_matches_html_escapes_menu_text_and_keywords():
+    _, html_body = _render_matches("2026-10-15", ["<b>poppers</b>", "jalapeno"], DETAILS)
+    assert "Magic words: &lt;b&gt;poppers&lt;/b&gt;, jalapeno" in html_body
+    assert "<Poppers>" not in html_body
+    assert html_body.count("Jalapeno &lt;Poppers&gt;") == 1
+    assert _HTML_ITEM.format("Jalapeno &lt;Poppers&gt;", "Breakfast, Dinner, Lunch") in html_body
+    assert _HTML_ITEM.format("Fried Rice &amp; Beans", "Lunch") in html_body
+    assert html_body.index("Baker House") < html_body.index("Simmons Hall")
+    assert html_body.index("Jalapeno &lt;Poppers&gt;") < html_body.index("Jalapeno Cornbread")
+    # The outer wrapper is left open for the unsubscribe footer.
+    assert html_body.count("<div") == html_body.count(_HTML_CLOSE) + 1